@@ -0,0 +1,149 @@
+"""Benchmarks for the dice_utils hot paths.
+
+Run with `python -m ttrpyg.benchmarks`. The first run (or any run with --save) stores the timings as the baseline,
+later runs compare against it and exit with an error if anything got slower than --threshold times its baseline.
+Baselines are machine specific, so keep them out of the repo and save a fresh one on each machine you compare on.
+"""
+
+import argparse
+import functools
+import json
+import os
+import sys
+import timeit
+from collections.abc import Callable
+
+import numpy as np
+
+import ttrpyg.dice_utils as du
+import ttrpyg.my_types as ty
+
+d100_table = ty.Entity(
+    {
+        "name": "Benchmark Table",
+        "table": du.compile_table(
+            {
+                "roll": "1d100",
+                "outcomes": {f"{i}-{i + 9}": f"outcome {i}" for i in range(1, 100, 10)},
+            }
+        ),
+    }
+)
+no_table_dice = ty.Curly(
+    {
+        "match": "{benchmark_table}",
+        "quantity_dice": "",
+        "table_dice": "",
+        "entity": "benchmark_table",
+        "quantity": 1,
+        "table_result": None,
+    }
+)
+
+
+def get_benchmarks() -> dict[str, Callable[[], object]]:
+    benchmarks: dict[str, Callable[[], object]] = {}
+    for n in (2, 4, 8, 16, 32, 64):
+        benchmarks[f"all_rolls counts {n}d6"] = functools.partial(
+            du.all_rolls, [6] * n, "counts"
+        )
+    for n in (2, 4, 6):
+        benchmarks[f"all_rolls all {n}d6"] = functools.partial(
+            du.all_rolls, [6] * n, "all"
+        )
+    for adv_range in (1, 3, 6, 10):
+        benchmarks[f"check_conditions adv_range={adv_range}"] = functools.partial(
+            du.check_conditions, adv_range
+        )
+    benchmarks["die_parser_roller 4d6x+2 x1000"] = lambda: [
+        du.die_parser_roller("4d6x+2") for i in range(1000)
+    ]
+    benchmarks["die_parser_roller_batch 4d6x+2 x100000"] = (
+        lambda: du.die_parser_roller_batch("4d6x+2", 100_000)
+    )
+    benchmarks["roll_on_table 1d100 x1000"] = lambda: [
+        du.roll_on_table(d100_table, no_table_dice) for i in range(1000)
+    ]
+    benchmarks["roll_on_table_many 1d100 x100000"] = lambda: du.roll_on_table_many(
+        d100_table, 100_000
+    )
+    benchmarks["get_pass_probability 20x20 grid"] = lambda: [
+        du.get_pass_probability(score, dc)
+        for score in range(-5, 15)
+        for dc in range(0, 20)
+    ]
+    benchmarks["pass_probability 200x200 grid"] = lambda: du.pass_probability(
+        np.arange(-100, 100)[:, None], np.arange(-100, 100)[None, :]
+    )
+    return benchmarks
+
+
+def time_benchmark(benchmark: Callable[[], object], repeat: int = 5) -> float:
+    """Best of repeat runs, in seconds per call."""
+    timer = timeit.Timer(benchmark)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(
+    baseline_path: str = "benchmark_baselines.json",
+    threshold: float = 1.5,
+    save: bool = False,
+    match: str = "",
+) -> list[str]:
+    """Runs every benchmark whose name contains match, returning the names of those that regressed."""
+    # benchmark name -> seconds per call
+    baselines: dict[str, float] = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, "r") as f:
+            baselines = json.loads(f.read())
+    timings: dict[str, float] = {}
+    regressions = []
+    for name, benchmark in get_benchmarks().items():
+        if match not in name:
+            continue
+        # the disk cache would turn most of these into file reads
+        disk_cache_setting = os.environ.get("TTRPYG_DISK_CACHE")
+        os.environ["TTRPYG_DISK_CACHE"] = "0"
+        try:
+            timings[name] = time_benchmark(benchmark)
+        finally:
+            if disk_cache_setting is None:
+                del os.environ["TTRPYG_DISK_CACHE"]
+            else:
+                os.environ["TTRPYG_DISK_CACHE"] = disk_cache_setting
+        line = f"{name:<45} {timings[name] * 1000:>10.3f} ms"
+        if name in baselines:
+            ratio = timings[name] / baselines[name]
+            line += f" {ratio:>6.2f}x baseline"
+            if ratio > threshold and not save:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+    if save or not baselines:
+        with open(baseline_path, "w") as f:
+            f.write(json.dumps({**baselines, **timings}, indent=2))
+        print(f"Saved baselines to {baseline_path}.")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--baseline", default="benchmark_baselines.json")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.5,
+        help="slowdown factor over the baseline that counts as a regression",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="overwrite the baselines with this run"
+    )
+    parser.add_argument(
+        "--match", default="", help="only run benchmarks with this in their name"
+    )
+    args = parser.parse_args()
+    regressions = run(args.baseline, args.threshold, args.save, args.match)
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
@@ -1,83 +1,561 @@
+import gc
+import hashlib
 import json
+import multiprocessing
 import os
+import pickle
+import stat
 from functools import reduce
-import re
+import tempfile
+import time
+import warnings
+from collections import deque
+from collections.abc import Generator, Hashable, Iterable, Iterator, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO, Any, Optional, Union
 
-from tinydb import TinyDB, where, Query
+import numpy as np
+from tinydb import TinyDB, Query
+from tinydb.storages import MemoryStorage
+from tinydb.table import Document
 
 import ttrpyg.my_types as ty
 import ttrpyg.text as tx
 import ttrpyg.dice_utils as du
+import ttrpyg.reference_graph as rg
+
+# bump whenever what gets stored for an entity changes (flattening, table compiling, ...),
+# so builds made by an older version get redone from scratch instead of being patched
+manifest_version = 1
+# and this whenever the snapshot's layout (or what the indexes look like) changes
+snapshot_version = 2
+# starting a pool costs about as much as parsing this many entity files, fewer are loaded in this process
+pool_min_files = 8
+
+
+# there's no reading the umask without setting it, and that's process wide, so it's read once here and not on every save
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def get_manifest_path(output_path: str) -> str:
+    return f"{output_path}.manifest"
+
+
+def get_snapshot_path(output_path: str) -> str:
+    return f"{output_path}.snapshot"
+
+
+def find_entity_files(path: str) -> list[str]:
+    """Every file under path (or path itself if it is a file), in os.listdir order."""
+    # look into getting a path-type
+    if os.path.isdir(path):
+        return [
+            file
+            for entry in os.listdir(path)
+            for file in find_entity_files(os.path.join(path, entry))
+        ]
+    return [path]
+
+
+def get_file_sha256(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_entity_file(path: str) -> tuple[str, list[str], list]:
+    """Reads one entity file, returning its sha256, its top level keys and its (flattened) entities."""
+    with open(path, "rb") as f:
+        content = f.read()
+    data = json.loads(content)
+    return hashlib.sha256(content).hexdigest(), list(data), flatten_entities(data)
+
+
+def load_entity_files(
+    paths: Mapping[str, str], workers: Optional[int] = None
+) -> Iterator[tuple[str, tuple[str, list[str], list]]]:
+    """load_entity_file on each of paths ({key: path}) in a pool of up to workers processes,
+    yielding (key, result) in the order of paths as results come in. workers=1 loads them in this process.
+    workers=None picks for you: one process per cpu where processes can be forked and there are at least pool_min_files paths,
+    this process otherwise. Spawned pools (workers > 1 on macOS, Windows) need the caller under an if __name__ == "__main__" guard.
+    """
+    context = None
+    if workers is None:
+        if (
+            "fork" in multiprocessing.get_all_start_methods()
+            and len(paths) >= pool_min_files
+        ):
+            context = multiprocessing.get_context("fork")
+        else:
+            workers = 1
+    workers = min(workers or os.cpu_count() or 1, len(paths))
+    executor = ProcessPoolExecutor(workers, mp_context=context) if workers > 1 else None
+    try:
+        yield from zip(
+            paths, (executor.map if executor else map)(load_entity_file, paths.values())
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def check_duplicate_keys(owners: dict[str, str], keys: list[str], key: str) -> None:
+    """Raises if any of keys (the top level keys of file key) is already in owners ({top level key: file}), adds them if not."""
+    intersection = set(owners.keys()) & set(keys)
+    if intersection:
+        raise KeyError(
+            f"Duplicate Key(s): {intersection} in {key}, already in "
+            f"{sorted({owners[entity_key] for entity_key in intersection})}"
+        )
+    owners.update(dict.fromkeys(keys, key))
+
+
+def _compound_pmf(quantities: dict[int, float], pmf: np.ndarray) -> np.ndarray:
+    """The pmf of the sum of a random number (distributed as quantities) of independent draws from pmf."""
+    if len(pmf) == 1:
+        return pmf * sum(quantities.values())
+    compound = np.zeros((len(pmf) - 1) * max(quantities) + 1)
+    power = np.ones(1)  # the pmf of the sum of quantity draws
+    for quantity in range(max(quantities) + 1):
+        if quantity in quantities:
+            compound[: len(power)] += quantities[quantity] * power
+        power = np.convolve(power, pmf)
+    return compound
+
+
+def warn_dangling(graph: rg.ReferenceGraph) -> None:
+    # these would only blow up once something holding them gets rendered, better to hear about it now
+    if dangling := graph.dangling():
+        missing = [
+            f"{target} (in {', '.join(sources[:3])}"
+            + (f" and {len(sources) - 3} more)" if len(sources) > 3 else ")")
+            for target, sources in dangling.items()
+        ]
+        warnings.warn(f"Reference(s) to missing entities: {', '.join(missing)}")
+
+
+def flatten_entities(data: dict, docs: Optional[list] = None) -> list:
+    """Pulls the entities (anything with a name) out of one entity file's nested dicts, compiling their tables."""
+    docs = [] if docs is None else docs
+    for k, v in data.items():
+        if "name" in v:
+            v["clean_name"] = tx.get_clean_name(v["name"])
+            if "table" in v.keys():
+                v["table"] = du.compile_table(v["table"])
+            docs.append(v)
+        else:
+            flatten_entities(v, docs)
+    return docs
+
+
+def get_replacement_mode(path: str) -> int:
+    """The mode for a file renamed over path: path's own, or what open() would have made it if there's no path yet."""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_umask
+
+
+def _write_atomic(path: str, content: Union[str, bytes]) -> None:
+    # written next to path and renamed into place, so readers never see half a file
+    with tempfile.NamedTemporaryFile(
+        "wb" if isinstance(content, bytes) else "w",
+        dir=os.path.dirname(os.path.abspath(path)),
+        suffix=".tmp",
+        delete=False,
+    ) as f:
+        f.write(content)
+    # temporary files are private, these shouldn't be
+    os.chmod(f.name, get_replacement_mode(path))
+    os.replace(f.name, path)
+
+
+# the db a generate_many worker process renders with, set once per process by _set_worker_db
+_worker_db: Optional["DB"] = None
+
+
+def _set_worker_db(db: "DB") -> None:
+    global _worker_db
+    _worker_db = db
+    db._prepare_worker()
+
+
+def _generate_in_worker(
+    text: str, seed_sequence: np.random.SeedSequence, kwargs: dict
+) -> str:
+    if _worker_db is None:
+        raise RuntimeError(
+            "No db in this process, _generate_in_worker runs in generate_many's pool."
+        )
+    return _worker_db.single_curly_parser(text, rng=du.RNG(seed_sequence), **kwargs)
 
 
 class DB(TinyDB):
-    def __init__(self, input_path: str = "./entities", output_path: str = "db.json"):
-        super().__init__(output_path)
+    # where TinyDB keeps the tables, SQLiteDB swaps in one that can't be written to
+    storage_class: type = MemoryStorage
+
+    def __init__(
+        self,
+        input_path: str = "./entities",
+        output_path: str = "db.json",
+        in_memory: bool = False,
+        workers: Optional[int] = None,
+    ):
+        """The db lives in memory. Unless in_memory is set, it is also written out to output_path (once, when the build is done).
+        Writes made after that aren't saved to output_path, call save() for that.
+        workers is how many processes load the entity files, see load_entity_files. By default a pool is only used where it can be forked,
+        workers=1 keeps loading in this process, workers > 1 asks for a pool anywhere.
+        """
+        super().__init__(storage=self.storage_class)
         self.input_path = input_path
         self.output_path = output_path
+        self.in_memory = in_memory
+        self.workers = workers
+        # indexes, kept in step with every write below so lookups never have to scan the table
+        self._docs: dict[int, Document] = {}
+        self._names: dict[str, list[int]] = {}  # clean_name -> doc_ids
+        # field -> doc_ids that have it, Hashable keys so they go through _index_document like the value indexes
+        self._fields: dict[Hashable, set[int]] = {}
+        self._list_fields: dict[Hashable, set[int]] = {}  # ... that have it as a list
+        # field -> value -> doc_ids, for list items and for (hashable) plain values
+        self._list_values: dict[str, dict[Hashable, set[int]]] = {}
+        self._scalar_values: dict[str, dict[Hashable, set[int]]] = {}
+        self._manifest: Optional[ty.Manifest] = None
+        # (clean_name, text_type, html_characters, include_full_text, skip_table) -> text, see render_entity_text
+        self._rendered: dict[tuple, str] = {}
+        # who references who, kept in step with the indexes
+        self._reference_graph = rg.ReferenceGraph()
         self._create_tinydb(input_path, output_path)
 
+    # writes to the default table, wrapped so the indexes stay consistent
+
+    def _index_document(self, doc: Document, remove: bool = False) -> None:
+        doc_id = doc.doc_id
+        # (index, key) pairs doc_id goes under
+        keys: list[tuple[dict[Hashable, set[int]], Hashable]] = []
+        for field, value in doc.items():
+            keys.append((self._fields, field))
+            if isinstance(value, list):
+                keys.append((self._list_fields, field))
+                values = self._list_values.setdefault(field, {})
+                # the plain types are checked first, the Hashable check is slow
+                keys.extend(
+                    (values, item)
+                    for item in value
+                    if isinstance(item, (str, int, float)) or isinstance(item, Hashable)
+                )
+            elif isinstance(value, (str, int, float)) or isinstance(value, Hashable):
+                keys.append((self._scalar_values.setdefault(field, {}), value))
+        if not remove:
+            for index, key in keys:
+                index.setdefault(key, set()).add(doc_id)
+            return
+        for index, key in keys:
+            if key in index:
+                index[key].discard(doc_id)
+                if not index[key]:
+                    del index[key]
+
+    def _reindex(self, doc_ids: Iterable[int]) -> None:
+        self._rendered.clear()
+        table = self.table(self.default_table_name)
+        for doc_id in doc_ids:
+            if (old := self._docs.pop(doc_id, None)) is not None:
+                self._index_document(old, remove=True)
+                name_ids = self._names[old.get("clean_name", "")]
+                name_ids.remove(doc_id)
+                if not name_ids:
+                    del self._names[old.get("clean_name", "")]
+                self._reference_graph.remove(old.get("clean_name", ""))
+            if (doc := table.get(doc_id=doc_id)) is not None:
+                self._docs[doc_id] = doc
+                self._index_document(doc)
+                self._names.setdefault(doc.get("clean_name", ""), []).append(doc_id)
+                if "clean_name" in doc:
+                    self._reference_graph.add(doc)  # type: ignore
+
+    def insert(self, document: Mapping) -> int:
+        doc_id = self.table(self.default_table_name).insert(document)
+        self._reindex([doc_id])
+        return doc_id
+
+    def insert_multiple(self, documents: Iterable[Mapping]) -> list[int]:
+        doc_ids = self.table(self.default_table_name).insert_multiple(documents)
+        self._reindex(doc_ids)
+        return doc_ids
+
+    def update(self, fields, cond=None, doc_ids=None) -> list[int]:
+        updated = self.table(self.default_table_name).update(fields, cond, doc_ids)
+        self._reindex(updated)
+        return updated
+
+    def update_multiple(self, updates) -> list[int]:
+        updated = self.table(self.default_table_name).update_multiple(updates)
+        self._reindex(updated)
+        return updated
+
+    def upsert(self, document: Mapping, cond=None) -> list[int]:
+        upserted = self.table(self.default_table_name).upsert(document, cond)
+        self._reindex(upserted)
+        return upserted
+
+    def remove(self, cond=None, doc_ids=None) -> list[int]:
+        removed = self.table(self.default_table_name).remove(cond, doc_ids)
+        self._reindex(removed)
+        return removed
+
+    def truncate(self) -> None:
+        self.table(self.default_table_name).truncate()
+        self._rendered.clear()
+        self._reference_graph.clear()
+        for index in (
+            self._docs,
+            self._names,
+            self._fields,
+            self._list_fields,
+            self._list_values,
+            self._scalar_values,
+        ):
+            index.clear()
+
     def _create_tinydb(
         self, input_path: str = "./entities", output_path: str = "db.json"
     ):
         """This function creates a flattened TinyDB db.
         !!! You should NOT write to this db !!!
-        !!! The db is overwritten every time the function is run !!!
+        !!! The db (and the output_path file) is rebuilt from input_path every time the function is run !!!
         The db does not preserve any hierarchy or table information.
         The function creates a db that is meant to be used only for querying, code functionality.
         This may be changed in the future.
+        Unless in_memory is set, a manifest of the entity files is kept next to output_path (see get_manifest_path),
+        and a rebuild only re-ingests the files that were added, changed or removed since output_path was written.
+        The built db, indexes included, is also pickled next to it (see get_snapshot_path), and loading that is much quicker than output_path.
+        The references between entities are collected along the way (see reference_graph), references to missing entities get a warning.
         """
+        manifest = None
+        from_snapshot = False
+        if not self.in_memory:
+            manifest = self._load_snapshot(output_path)
+            from_snapshot = manifest is not None
+            manifest = manifest or self._load_previous_build(output_path)
+        if manifest is None:
+            self.truncate()
+            previous_files = {}
+        else:
+            previous_files = manifest["files"]
 
-        def build_db(data):
-            for k, v in data.items():
-                if "name" in v:
-                    v["clean_name"] = tx.get_clean_name(v["name"])
-                    self.insert(v)
-                else:
-                    build_db(v)
+        # stat first, files only get loaded when the stat changed (edited, touched, copied, checked out)
+        files: dict[str, ty.ManifestFile] = {}
+        to_load: dict[str, str] = {}  # key -> path
+        for path in find_entity_files(input_path):
+            key = (
+                os.path.relpath(path, input_path) if os.path.isdir(input_path) else path
+            )
+            file_stat = os.stat(path)
+            previous = previous_files.get(key)
+            files[key] = ty.ManifestFile(
+                {
+                    "mtime_ns": file_stat.st_mtime_ns,
+                    "size": file_stat.st_size,
+                    "sha256": previous["sha256"] if previous else "",
+                    "keys": previous["keys"] if previous else [],
+                    "doc_ids": previous["doc_ids"] if previous else [],
+                }
+            )
+            if previous is None or files[key] != previous:
+                # hashing is much cheaper than loading, and a file that was only touched needs neither its docs nor its keys checked again
+                if previous is None or get_file_sha256(path) != previous["sha256"]:
+                    to_load[key] = path
+        removed = [
+            doc_id
+            for key, previous in previous_files.items()
+            if key not in files
+            for doc_id in previous["doc_ids"]
+        ]
+        owners = {  # top level key -> the file it's from
+            entity_key: key
+            for key, file in files.items()
+            if key not in to_load
+            for entity_key in file["keys"]
+        }
+        stale: list[int] = []
+        new_docs: dict[str, list] = {}  # key -> docs, written once everything is in
+        # owners holds every unchanged file's keys by now, so changed files get checked against all of them
+        # parsing and table compiling happen in a pool, results come back in file order as they finish
+        for key, (sha256, keys, docs) in load_entity_files(to_load, self.workers):
+            check_duplicate_keys(owners, keys, key)
+            stale.extend(files[key]["doc_ids"])
+            files[key] = {**files[key], "sha256": sha256, "keys": keys}
+            new_docs[key] = docs
+        # a single remove and insert, tinydb copies the whole table on every write
+        if removed or stale:
+            self.remove(doc_ids=removed + stale)
+        if new_docs:
+            doc_ids = iter(
+                self.insert_multiple(doc for docs in new_docs.values() for doc in docs)
+            )
+            for key, docs in new_docs.items():
+                files[key]["doc_ids"] = [next(doc_ids) for doc in docs]
+        # names have to be unique for fetch_by_name, better to find out now than mid-render
+        duplicates = {name for name, doc_ids in self._names.items() if len(doc_ids) > 1}
+        if duplicates:
+            raise KeyError(f"Duplicate clean_name(s): {duplicates}")
+        warn_dangling(self._reference_graph)
 
-        def wrangle_jsons(path: str, aggregated: dict = {}):
-            # look into getting a path-type
-            if os.path.isdir(path):
-                for p in [os.path.join(path, entry) for entry in os.listdir(path)]:
-                    aggregated = wrangle_jsons(p, aggregated)
+        if not self.in_memory:
+            self._manifest = ty.Manifest(
+                {
+                    "version": manifest_version,
+                    "input_path": os.path.abspath(input_path),
+                    "db_sha256": manifest["db_sha256"] if manifest else "",
+                    "files": files,
+                }
+            )
+            if manifest is None or new_docs or removed:
+                self.save(output_path)
             else:
-                with open(path, "r") as f:
-                    temp = json.loads(f.read())
-                intersection = set(aggregated.keys()) & set(temp.keys())
-                if intersection:
-                    raise KeyError(f"Duplicate Key(s): {intersection}")
-                aggregated = {**aggregated, **temp}
-            return aggregated
-
-        def get_expanded_outcomes(table: ty.Table):
-            expanded_outcomes = {}
-            for k, v in table["outcomes"].items():
-                if (
-                    type(k) == str
-                    and (match_k := re.search(r"(\d*)-(\d*)", k)) is not None
-                ):
-                    start, end = match_k.groups()
-                    for new_k in range(int(start), int(end) + 1):
-                        expanded_outcomes[int(new_k)] = v
-                else:
-                    expanded_outcomes[int(k)] = v
-            table["expanded_outcomes"] = expanded_outcomes
-            return table
-
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        build_db(wrangle_jsons(input_path))
-
-        for doc in self.all():
-            if "table" in doc.keys():
-                table = get_expanded_outcomes(doc["table"])
-                self.update({"table": table}, doc_ids=[doc.doc_id])
-                if "roll" not in doc["table"].keys():
-                    table["roll"] = "1d" + str(max(table["expanded_outcomes"].keys()))
-                    self.update({"table": table}, doc_ids=[doc.doc_id])
+                if files != previous_files:
+                    # only stats moved, the db itself is still good
+                    _write_atomic(
+                        get_manifest_path(output_path), json.dumps(self._manifest)
+                    )
+                if not from_snapshot:
+                    self._save_snapshot(output_path, self._manifest)
         return self
 
+    def _read_manifest(self, output_path: str) -> Optional[ty.Manifest]:
+        # None unless it's a manifest for a build of the same input_path by this version
+        try:
+            with open(get_manifest_path(output_path), "r") as f:
+                manifest: ty.Manifest = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if (
+            not isinstance(manifest, dict)
+            or manifest.get("version") != manifest_version
+            or manifest.get("input_path") != os.path.abspath(self.input_path)
+        ):
+            return None
+        return manifest
+
+    def _load_snapshot(self, output_path: str) -> Optional[ty.Manifest]:
+        """Restores the db and its indexes from output_path's snapshot, if the snapshot is of the build the manifest describes.
+        Returns the manifest, or None (leaving the db alone) when there's no usable snapshot.
+        The snapshot is a pickle, so only point output_path at places you'd run code from.
+        """
+        manifest = self._read_manifest(output_path)
+        if manifest is None:
+            return None
+        # restoring makes a lot of objects and none of them are garbage, collecting while it runs just wastes time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            try:
+                with open(get_snapshot_path(output_path), "rb") as f:
+                    snapshot = pickle.loads(f.read())
+            except (
+                OSError,
+                pickle.UnpicklingError,
+                EOFError,
+                AttributeError,
+                ImportError,
+            ):
+                return None
+            if (
+                not isinstance(snapshot, dict)
+                or snapshot.get("version") != snapshot_version
+                or snapshot.get("db_sha256") != manifest["db_sha256"]
+            ):
+                return None
+            self.truncate()
+            (
+                self._docs,
+                self._names,
+                self._fields,
+                self._list_fields,
+                self._list_values,
+                self._scalar_values,
+                self._reference_graph,
+            ) = snapshot["indexes"]
+            # the indexed documents are the default table's rows, so they're only stored once
+            # (copies though, tinydb updates rows in place and the index needs the old values to clean up)
+            self.storage.write(
+                {
+                    **snapshot["other_tables"],
+                    self.default_table_name: {
+                        str(doc_id): dict(doc) for doc_id, doc in self._docs.items()
+                    },
+                }
+            )
+            return manifest
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load_previous_build(self, output_path: str) -> Optional[ty.Manifest]:
+        """Loads output_path into the db if its manifest says it's a build of the same input_path by this version.
+        Returns the manifest, or None (leaving the db alone) when there's nothing usable to build on.
+        """
+        manifest = self._read_manifest(output_path)
+        if manifest is None:
+            return None
+        try:
+            with open(output_path, "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        if manifest["db_sha256"] != hashlib.sha256(content).hexdigest():
+            return None
+        self.truncate()
+        self.storage.write(json.loads(content))
+        self._reindex(
+            int(doc_id)
+            for doc_id in self._read_tables().get(self.default_table_name, {})
+        )
+        return manifest
+
+    def save(self, output_path: Optional[str] = None) -> None:
+        """Writes the db to output_path (default self.output_path) in TinyDB's JSON format, and the manifest and snapshot next to it.
+        All of them are written atomically, so readers never see half a db.
+        """
+        output_path = output_path or self.output_path
+        content = json.dumps(self._read_tables())
+        _write_atomic(output_path, content)
+        if self._manifest is not None:
+            self._manifest["db_sha256"] = hashlib.sha256(
+                content.encode("utf-8")
+            ).hexdigest()
+            _write_atomic(get_manifest_path(output_path), json.dumps(self._manifest))
+            self._save_snapshot(output_path, self._manifest)
+
+    def _read_tables(self) -> dict[str, dict[str, dict]]:
+        # the storage reads None until the first write
+        return self.storage.read() or {}
+
+    def _save_snapshot(self, output_path: str, manifest: ty.Manifest) -> None:
+        snapshot = {
+            "version": snapshot_version,
+            "db_sha256": manifest["db_sha256"],
+            "other_tables": {
+                name: table
+                for name, table in self._read_tables().items()
+                if name != self.default_table_name
+            },
+            "indexes": (
+                self._docs,
+                self._names,
+                self._fields,
+                self._list_fields,
+                self._list_values,
+                self._scalar_values,
+                self._reference_graph,
+            ),
+        }
+        _write_atomic(
+            get_snapshot_path(output_path),
+            pickle.dumps(snapshot, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+
     # parsers! doesnt use the tinydb features
 
     def single_curly_parser(
@@ -85,46 +563,153 @@ class DB(TinyDB):
         text: str,
         expand_entities: bool = False,
         roll_dice: bool = False,
+        rng: Optional[du.RNG] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
     ) -> str:
+        """rng, if passed, is used for every roll made while parsing and expanding, so the result can be replayed.
+        The budgets limit expansion, see expand_entity_tree.
+        """
+        rng = du.get_rng(rng)
         if not (text.startswith("{") and text.endswith("}")):
             text = "{" + text + "}"
-        curlies_parsed = tx.parse_curlies(text)
+        curlies_parsed = tx.parse_curlies(text, rng)
         assert len(curlies_parsed) == 1
         base_curly = curlies_parsed[0]
         # case when only die roll is present
         if not base_curly["entity"]:
-            return str(du.die_parser_roller(base_curly["quantity_dice"]))
+            return str(du.die_parser_roller(base_curly["quantity_dice"], rng))
         # all other cases
-        return self.generate_entity_tree_text(base_curly, expand_entities, roll_dice)
+        return self.generate_entity_tree_text(
+            base_curly,
+            expand_entities,
+            roll_dice,
+            rng=rng,
+            max_nodes=max_nodes,
+            max_depth=max_depth,
+            time_budget=time_budget,
+        )
+
+    def generate_many(
+        self,
+        curlies: Union[str, list[str]],
+        count: Optional[int] = None,
+        expand_entities: bool = True,
+        roll_dice: bool = True,
+        seed: Union[int, du.RNG, None] = None,
+        workers: Optional[int] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> list[str]:
+        """single_curly_parser on each of curlies (or on curlies count times), spread over a pool of workers processes
+        (default one per cpu, workers=1 stays in this process). Results come back in order.
+        Each one gets its own child stream of seed, so a seeded batch replays exactly, whatever the number of workers.
+        Where processes can be forked, the workers share this db as it is in memory, otherwise each one reopens it from its paths.
+        """
+        if isinstance(curlies, str):
+            curlies = [curlies] * (1 if count is None else count)
+        elif count is not None:
+            raise ValueError("count only goes with a single curly.")
+        rng = seed if isinstance(seed, du.RNG) else du.RNG(seed)
+        seed_sequences = rng.seed_sequence.spawn(len(curlies))
+        kwargs: dict[str, Any] = {
+            "expand_entities": expand_entities,
+            "roll_dice": roll_dice,
+            "max_nodes": max_nodes,
+            "max_depth": max_depth,
+            "time_budget": time_budget,
+        }
+        workers = min(workers or os.cpu_count() or 1, len(curlies))
+        if workers <= 1:
+            return [
+                self.single_curly_parser(text, rng=du.RNG(seed_sequence), **kwargs)
+                for text, seed_sequence in zip(curlies, seed_sequences)
+            ]
+        # forked workers get the catalog for free (copy on write), no rebuilding or pickling it
+        context = (
+            multiprocessing.get_context("fork")
+            if "fork" in multiprocessing.get_all_start_methods()
+            else None
+        )
+        with ProcessPoolExecutor(
+            workers, mp_context=context, initializer=_set_worker_db, initargs=(self,)
+        ) as executor:
+            return list(
+                executor.map(
+                    _generate_in_worker,
+                    curlies,
+                    seed_sequences,
+                    [kwargs] * len(curlies),
+                    chunksize=max(1, len(curlies) // (workers * 4)),
+                )
+            )
+
+    def _prepare_worker(self) -> None:
+        # called in each generate_many worker process, for subclasses holding things that can't cross a fork
+        pass
+
+    def __reduce__(self):
+        # only needed where generate_many can't fork: the worker opens the same db again
+        return type(self), (self.input_path, self.output_path, self.in_memory, 1)
 
     # tinydb querying
 
+    @property
+    def reference_graph(self) -> rg.ReferenceGraph:
+        """Which entities reference which, see reference_graph.ReferenceGraph. Don't modify it, it's kept in step with the db."""
+        return self._reference_graph
+
     def fetch_by_name(self, name: str):
         """Fetches an entity by name by first converting it to clean_name.
         As a result, passing a clean_name is fine too.
         This function should not change even if the db does.
+        The returned document is the one held by the index, so don't modify it.
         """
-        # I really dont love this. Wish TinyDB let me set an index.
-        result = self.search(where("clean_name") == tx.get_clean_name(name))
-        assert len(result) == 1
-        return result[0]
+        doc_ids = self._names.get(tx.get_clean_name(name), [])
+        if len(doc_ids) != 1:
+            raise KeyError(f"{len(doc_ids)} entities named {name!r}, expected 1.")
+        return self._docs[doc_ids[0]]
 
     def get_unique_array_field_values(self):
-        unique_field_values = {}  # {..., "FIELDNAME": set()}
-        for doc in self.all():
-            for k, v in doc.items():
-                if isinstance(v, list):
-                    if k not in unique_field_values:
-                        unique_field_values[k] = set()
-                    for i in v:
-                        unique_field_values[k].add(i)
-        for k, v in unique_field_values.items():
-            unique_field_values[k] = list(sorted(v))
-        return unique_field_values
+        # straight from the index, no need to look at the documents
+        return {
+            field: list(sorted(self._list_values.get(field, {})))
+            for field in self._list_fields
+        }
 
     def filter_entities(self, fields: list, params: list[list | str]):
-        query = Query()
+        """Entities where every field matches its param: equal to it for a str param, containing all of it for a list param.
+        Answered from the indexes by intersecting the smallest candidate sets first.
+        Returns copies like TinyDB's search does, so changing them doesn't touch the db.
+        """
         assert len(fields) == len(params)
+        candidates = []
+        for field, param in zip(fields, params):
+            if isinstance(param, str):
+                candidates.append(self._scalar_values.get(field, {}).get(param, set()))
+            elif self._list_fields.get(field, set()) != self._fields.get(field, set()):
+                # TinyDB's .all() on a string is a substring test, the index can't answer that
+                return self._filter_entities_query(fields, params)
+            else:
+                candidates.append(self._list_fields.get(field, set()))
+                candidates += [
+                    self._list_values.get(field, {}).get(value, set())
+                    for value in param
+                ]
+        candidates.sort(key=len)
+        doc_ids = set(candidates[0])
+        for candidate in candidates[1:]:
+            if not doc_ids:
+                break
+            doc_ids &= candidate
+        return [
+            Document(dict(self._docs[doc_id]), doc_id) for doc_id in sorted(doc_ids)
+        ]
+
+    def _filter_entities_query(self, fields: list, params: list[list | str]):
+        query = Query()
         field = fields[0]
         param = params[0]
 
@@ -151,6 +736,34 @@ class DB(TinyDB):
 
     # entity tree related stuff
 
+    def render_entity_text(
+        self,
+        name: str,
+        text_type: str = "md",
+        html_characters: bool = False,
+        include_full_text: bool = False,
+        skip_table: bool = False,
+    ) -> str:
+        """tx.generate_entity_text of the entity called name, cached until the db is written to.
+        Rendering is the slow part of expanding trees, and the same entity tends to show up a lot in them.
+        """
+        key = (
+            tx.get_clean_name(name),
+            text_type,
+            html_characters,
+            include_full_text,
+            skip_table,
+        )
+        if key not in self._rendered:
+            self._rendered[key] = tx.generate_entity_text(
+                self.fetch_by_name(name),
+                text_type,
+                html_characters,
+                include_full_text,
+                skip_table,
+            )
+        return self._rendered[key]
+
     @staticmethod
     def get_replacement_text(
         base_text: str,
@@ -167,29 +780,73 @@ class DB(TinyDB):
                 )
         return base_text
 
-    def generate_entity_tree_and_non_unique(
+    def iter_entity_tree(
         self,
         base_curly: ty.Curly,
         expand_entities: bool = False,
         roll_dice: bool = False,
         html_characters: bool = False,
-    ) -> tuple[ty.EntityTree, ty.NonUniqueEntities]:
-        non_unique_entities = ty.NonUniqueEntities({})
-        entity_tree = ty.EntityTree([])
-        curly_queue = [[base_curly] * base_curly["quantity"]]
-        while len(curly_queue) != 0 and len(entity_tree) < 100:
-            # TODO: looking back up the tree to not recurse
-            curlies = curly_queue.pop(0)
-            parent_id = len(entity_tree) - 1
-            for curly in curlies:  # note that this single element is a list of curlies
-                # skips case where the curly is just a roll.
-                if not curly["entity"]:
-                    continue
+        rng: Optional[du.RNG] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> Generator[ty.TreeEntry, None, ty.EntityExpansion]:
+        """expand_entity_tree, yielding each node as soon as it is expanded instead of building the tree.
+        Nodes aren't kept, so their children are left empty (parent links them up). When it's done, the generator returns
+        the expansion without its tree: non_unique, truncated, reason and cycles are only complete then.
+        """
+        rng = du.get_rng(rng)
+        deadline = None if time_budget is None else time.perf_counter() + time_budget
+        expansion = ty.EntityExpansion(
+            {
+                "tree": ty.EntityTree([]),
+                "nodes": 0,
+                "non_unique": ty.NonUniqueEntities({}),
+                "truncated": False,
+                "reason": None,
+                "cycles": [],
+            }
+        )
+        non_unique_entities = expansion["non_unique"]
+        # the cycles already listed, the list is only there for their order
+        seen_cycles: set[tuple[str, ...]] = set()
+
+        def truncate(reason: str) -> None:
+            expansion["truncated"] = True
+            expansion["reason"] = expansion["reason"] or reason
+
+        # (curly, how many of it, parent id, depth, clean_names from the base down to the parent)
+        queue: deque[tuple[ty.Curly, int, Optional[int], int, tuple[str, ...]]] = deque(
+            [(base_curly, base_curly["quantity"], None, 0, ())]
+        )
+        while queue:
+            curly, quantity, parent_id, depth, ancestors = queue.popleft()
+            # skips case where the curly is just a roll.
+            if not curly["entity"]:
+                continue
+            if curly["entity"] in ancestors:
+                cycle = (*ancestors, curly["entity"])
+                if cycle not in seen_cycles:
+                    seen_cycles.add(cycle)
+                    expansion["cycles"].append(list(cycle))
+                continue
+            if max_depth is not None and depth > max_depth:
+                truncate("max_depth")
+                continue
+            for i in range(quantity):
+                if max_nodes is not None and expansion["nodes"] >= max_nodes:
+                    truncate("max_nodes")
+                    queue.clear()
+                    break
+                if deadline is not None and time.perf_counter() > deadline:
+                    truncate("time_budget")
+                    queue.clear()
+                    break
                 # uniqueness testing
                 entity = self.fetch_by_name(curly["entity"])
                 has_table = "table" in entity.keys()
-                entity_text = tx.generate_entity_text(
-                    entity,
+                entity_text = self.render_entity_text(
+                    curly["entity"],
                     text_type="md",
                     html_characters=html_characters,
                     skip_table=roll_dice,
@@ -197,9 +854,11 @@ class DB(TinyDB):
                 )
                 if roll_dice and has_table:  # now we handle that table we skipped!
                     entity_text += (
-                        f"Table Result:  \n" + du.roll_on_table(entity, curly) + "\n"
+                        f"Table Result:  \n"
+                        + du.roll_on_table(entity, curly, rng=rng)
+                        + "\n"
                     )
-                curlies_parsed = tx.parse_curlies(entity_text)
+                curlies_parsed = tx.parse_curlies(entity_text, rng)
                 if any(
                     [inner_curly["quantity_dice"] for inner_curly in curlies_parsed]
                 ) or (has_table and roll_dice):
@@ -225,68 +884,351 @@ class DB(TinyDB):
                     entity_text = self.get_replacement_text(
                         base_text=entity_text, curlies_parsed=curlies_parsed
                     )
-                    for curly in curlies_parsed:
-                        if not curly["entity"] or curly["quantity"] == 0:
-                            pass
-                        else:
-                            curly_queue += [[curly] * curly["quantity"]]
+                    children = [
+                        (inner_curly, inner_curly["quantity"])
+                        for inner_curly in curlies_parsed
+                        if inner_curly["entity"] and inner_curly["quantity"] != 0
+                    ]
                 else:
-                    curly_queue.append(tx.parse_curlies(entity_text))
-                if parent_id >= 0:
-                    entity_tree[parent_id]["children"].append(len(entity_tree) - 1)
-                entity_tree.append(
-                    ty.TreeEntry(
-                        {
-                            "id": len(entity_tree),
-                            "entity": curly["entity"],
-                            "children": [],
-                            "unique": unique,
-                            "text": entity_text,
-                            "curly": curly,
-                        }
+                    # without rolls every entity is shown once, and non unique ones aren't expanded
+                    children = [
+                        (inner_curly, 1)
+                        for inner_curly in tx.parse_curlies(entity_text, rng)
+                    ]
+                node_id = expansion["nodes"]
+                expansion["nodes"] += 1
+                yield ty.TreeEntry(
+                    {
+                        "id": node_id,
+                        "entity": curly["entity"],
+                        "children": [],
+                        "unique": unique,
+                        "text": entity_text,
+                        "curly": curly,
+                        "parent": parent_id,
+                        "depth": depth,
+                    }
+                )
+                queue.extend(
+                    (
+                        inner_curly,
+                        inner_quantity,
+                        node_id,
+                        depth + 1,
+                        (*ancestors, curly["entity"]),
                     )
+                    for inner_curly, inner_quantity in children
                 )
-        return entity_tree, non_unique_entities
+        return expansion
 
-    def generate_entity_tree_text(
+    def expand_entity_tree(
         self,
         base_curly: ty.Curly,
         expand_entities: bool = False,
         roll_dice: bool = False,
         html_characters: bool = False,
-    ) -> str:
+        rng: Optional[du.RNG] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> ty.EntityExpansion:
+        """Expands base_curly breadth first into the tree of entities it holds (and they hold, and so on).
+        Expansion stops at max_nodes nodes or after time_budget seconds, and doesn't go deeper than max_depth (the base is depth 0).
+        None means no limit. If a budget cut the tree short, truncated is set and reason says which one did first.
+        An entity holding one of its own ancestors isn't expanded again, the path to it is listed in cycles instead.
+        """
+        nodes = self.iter_entity_tree(
+            base_curly,
+            expand_entities,
+            roll_dice,
+            html_characters,
+            rng,
+            max_nodes,
+            max_depth,
+            time_budget,
+        )
+        entity_tree = ty.EntityTree([])
+        while True:
+            try:
+                node = next(nodes)
+            except StopIteration as stop:
+                expansion = stop.value
+                break
+            if node["parent"] is not None:
+                entity_tree[node["parent"]]["children"].append(node["id"])
+            entity_tree.append(node)
+        expansion["tree"] = entity_tree
+        return expansion
+
+    def generate_entity_tree_and_non_unique(
+        self,
+        base_curly: ty.Curly,
+        expand_entities: bool = False,
+        roll_dice: bool = False,
+        html_characters: bool = False,
+        rng: Optional[du.RNG] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> tuple[ty.EntityTree, ty.NonUniqueEntities]:
+        """expand_entity_tree, without saying whether it was truncated."""
+        expansion = self.expand_entity_tree(
+            base_curly,
+            expand_entities,
+            roll_dice,
+            html_characters,
+            rng,
+            max_nodes,
+            max_depth,
+            time_budget,
+        )
+        return expansion["tree"], expansion["non_unique"]
+
+    def get_entity_count_distributions(
+        self,
+        curly_text: str,
+        entities: Optional[Iterable[str]] = None,
+        tolerance: float = 1e-12,
+    ) -> dict[str, dict[int, float]]:
+        """Exact distributions of how many of each of entities the curlies in curly_text expand into (rolling dice, without budgets),
+        worked out on the reference graph instead of by expanding them over and over. entities defaults to the leaves (entities holding nothing) they can reach.
+        Returns clean_name -> {count: probability}.
+        Like the expander, tables are bound like roll_on_table does, every copy of a curly with table dice lands on the same row and cycles aren't followed.
+        Exploding dice are cut off at tolerance like in dice_stats, so their distributions can add up to a hair under 1.
+        Raises KeyError for missing entities and ValueError for a table roll that can land between its rows.
+        """
+        graph = self.reference_graph
+        none = np.ones(1)  # certainly zero of it
+        reachable: dict[str, frozenset[str]] = {}
+        # (clean_name, table row, its ancestors that it can reach, entity counted) -> count pmf of one node
+        node_pmfs: dict[tuple, np.ndarray] = {}
+
+        def get_reachable(name: str) -> frozenset[str]:
+            if name not in reachable:
+                reachable[name] = frozenset(graph.reachable(name))
+            return reachable[name]
+
+        def get_rows(name: str, table_dice: str) -> list[tuple[Optional[int], float]]:
+            entity = self.fetch_by_name(name)
+            if "table" not in entity.keys():
+                return [(None, 1.0)]
+            probabilities = du.table_row_probabilities(
+                entity["table"], table_dice or None
+            )
+            if probabilities is None:
+                raise ValueError(
+                    f"Rolling {table_dice or entity['table']['roll']} on {name} can land between its rows."
+                )
+            return [(row, p) for row, p in enumerate(probabilities) if p > 0]
+
+        def mix(weighted: list[tuple[float, np.ndarray]]) -> np.ndarray:
+            mixture = np.zeros(max(len(pmf) for _, pmf in weighted))
+            for weight, pmf in weighted:
+                mixture[: len(pmf)] += weight * pmf
+            return mixture
+
+        def get_node_pmf(
+            name: str, row: Optional[int], ancestors: frozenset[str], entity: str
+        ) -> np.ndarray:
+            if entity != name and entity not in get_reachable(name):
+                return none
+            # ancestors it can't reach can't cut anything off, leaving them out lets acyclic subtrees share one entry
+            key = (name, row, ancestors & get_reachable(name), entity)
+            if key not in node_pmfs:
+                pmf = np.array([0.0, 1.0]) if name == entity else none
+                for reference in graph.references[name]:
+                    if reference["row"] is None or reference["row"] == row:
+                        pmf = np.convolve(
+                            pmf,
+                            get_curly_pmf(
+                                reference["curly"], ancestors | {name}, entity
+                            ),
+                        )
+                node_pmfs[key] = pmf
+            return node_pmfs[key]
+
+        def get_curly_pmf(
+            curly: ty.Curly, ancestors: frozenset[str], entity: str
+        ) -> np.ndarray:
+            name = curly["entity"]
+            if name in ancestors:
+                return none
+            rows = get_rows(name, curly["table_dice"])
+            if curly["quantity_dice"]:
+                quantities = du.dice_stats(curly["quantity_dice"], tolerance)["pmf"]
+            else:
+                quantities = {curly["quantity"]: 1.0}
+            if curly["table_dice"]:
+                # the curly's table dice are rolled once, so all of its copies land on the same row
+                return mix(
+                    [
+                        (
+                            p,
+                            _compound_pmf(
+                                quantities, get_node_pmf(name, row, ancestors, entity)
+                            ),
+                        )
+                        for row, p in rows
+                    ]
+                )
+            return _compound_pmf(
+                quantities,
+                mix(
+                    [(p, get_node_pmf(name, row, ancestors, entity)) for row, p in rows]
+                ),
+            )
+
+        curlies = [curly for curly in tx.compile_curlies(curly_text) if curly["entity"]]
+        for curly in curlies:
+            self.fetch_by_name(curly["entity"])
+        if entities is None:
+            entities = sorted(
+                name
+                for name in set().union(
+                    *(
+                        {curly["entity"], *get_reachable(curly["entity"])}
+                        for curly in curlies
+                    )
+                )
+                if name in graph and not graph.references[name]
+            )
+        distributions = {}
+        for entity in entities:
+            entity = tx.get_clean_name(entity)
+            pmf = none
+            for curly in curlies:
+                pmf = np.convolve(pmf, get_curly_pmf(curly, frozenset(), entity))
+            distributions[entity] = {
+                count: float(p) for count, p in enumerate(pmf) if p > 0
+            }
+        return distributions
+
+    def _get_unexpanded_text(
+        self,
+        base_curly: ty.Curly,
+        expand_entities: bool,
+        roll_dice: bool,
+        html_characters: bool,
+        rng: du.RNG,
+    ) -> Optional[str]:
+        # the text when there's no tree to expand, None when there is
+
         def text_has_children(text: str) -> bool:
-            return any([curly["entity"] for curly in tx.parse_curlies(text)])
+            return any([curly["entity"] for curly in tx.parse_curlies(text, rng)])
 
         base_quantity = base_curly["quantity"]
         # just need this line for the fancy name:
         base_entity = self.fetch_by_name(base_curly["entity"])
-        base_entity_text = tx.generate_entity_text(
-            base_entity, html_characters=html_characters
+        base_entity_text = self.render_entity_text(
+            base_curly["entity"], html_characters=html_characters
         )
         if not expand_entities or not text_has_children(base_entity_text):
             if roll_dice:
                 n_base_entity = str(base_quantity) + " " + base_entity["name"] + "  \n"
-                curlies_parsed = tx.parse_curlies(base_entity_text)
+                curlies_parsed = tx.parse_curlies(base_entity_text, rng)
                 return n_base_entity + self.get_replacement_text(
                     base_text=base_entity_text, curlies_parsed=curlies_parsed
                 )
             else:
                 return base_entity_text
-        entity_tree, non_unique_entities = self.generate_entity_tree_and_non_unique(
-            base_curly, expand_entities, roll_dice
+        return None
+
+    def generate_entity_tree_text(
+        self,
+        base_curly: ty.Curly,
+        expand_entities: bool = False,
+        roll_dice: bool = False,
+        html_characters: bool = False,
+        rng: Optional[du.RNG] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> str:
+        """The budgets are expand_entity_tree's. A tree they cut short, or one with cycles, says so at the end.
+        It's iter_entity_tree_text joined up, so the unique entities come first and the non unique ones after them.
+        """
+        return "".join(
+            self.iter_entity_tree_text(
+                base_curly,
+                expand_entities,
+                roll_dice,
+                html_characters,
+                rng,
+                max_nodes,
+                max_depth,
+                time_budget,
+            )
+        ).strip()
+
+    def iter_entity_tree_text(
+        self,
+        base_curly: ty.Curly,
+        expand_entities: bool = False,
+        roll_dice: bool = False,
+        html_characters: bool = False,
+        rng: Optional[du.RNG] = None,
+        max_nodes: Optional[int] = 100,
+        max_depth: Optional[int] = None,
+        time_budget: Optional[float] = None,
+    ) -> Iterator[str]:
+        """The text of the tree, in chunks yielded while it is still expanding, so memory stays flat. generate_entity_tree_text joins them up.
+        The unique entities come as they are expanded, the non unique ones last (they can only be counted once the tree is done).
+        """
+        rng = du.get_rng(rng)
+        unexpanded_text = self._get_unexpanded_text(
+            base_curly, expand_entities, roll_dice, html_characters, rng
         )
-        if not len(non_unique_entities) == 0:
-            non_unique_text = """### Non Unique Entities:\n"""
-            for clean_name, v in non_unique_entities.items():
-                non_unique_text += f"\n{v['count']} {clean_name}  \n\n{v['text']}"
-        else:
-            non_unique_text = ""
-        entity_text = """### Unique Entities, Full Tree:\n"""
-        for n in entity_tree:
-            if n["unique"]:
-                entity_text += "\n" + n["text"]
-        return (non_unique_text + "\n" + entity_text).strip()
+        if unexpanded_text is not None:
+            yield unexpanded_text
+            return
+        nodes = self.iter_entity_tree(
+            base_curly,
+            expand_entities,
+            roll_dice,
+            rng=rng,
+            max_nodes=max_nodes,
+            max_depth=max_depth,
+            time_budget=time_budget,
+        )
+        yield """### Unique Entities, Full Tree:\n"""
+        while True:
+            try:
+                node = next(nodes)
+            except StopIteration as stop:
+                expansion = stop.value
+                break
+            if node["unique"]:
+                yield "\n" + node["text"]
+        if expansion["non_unique"]:
+            yield """\n\n### Non Unique Entities:\n"""
+            for clean_name, v in expansion["non_unique"].items():
+                yield f"\n{v['count']} {clean_name}  \n\n{v['text']}"
+        yield self.get_expansion_notes(expansion)
+
+    def write_entity_tree_text(self, file: IO[str], *args, **kwargs) -> None:
+        """Writes iter_entity_tree_text(*args, **kwargs) to file as it comes, file being anything with a write(str).
+        For a socket, that's socket.makefile("w").
+        """
+        for chunk in self.iter_entity_tree_text(*args, **kwargs):
+            file.write(chunk)
+
+    @staticmethod
+    def get_expansion_notes(expansion: ty.EntityExpansion) -> str:
+        """Says if (and why) the tree is incomplete, so a cut short tree can't pass for a whole one."""
+        notes = ""
+        if expansion["truncated"] and (reason := expansion["reason"]) is not None:
+            budget = {
+                "max_nodes": f"the node budget ({expansion['nodes']} entities)",
+                "max_depth": "the depth budget",
+                "time_budget": "the time budget",
+            }[reason]
+            notes += f"\n\n### Truncated:\n\nExpansion stopped at {budget}, this tree is incomplete.\n"
+        if expansion["cycles"]:
+            notes += "\n\n### Cycles, Not Expanded Again:\n\n"
+            notes += "".join(
+                " -> ".join(cycle) + "  \n" for cycle in expansion["cycles"]
+            )
+        return notes
 
     # docs
 
@@ -1,16 +1,70 @@
+import bisect
 import itertools
+import math
 import re
 import random
-from typing import Union
-from collections import Counter
-import heapq
-from functools import cache
-from random import randint
+from typing import Union, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import cache, lru_cache
 import logging
 
+import numpy as np
 import pandas as pd
 
 import ttrpyg.my_types as ty
+import ttrpyg.disk_cache as dc
+
+
+class RNG:
+    """A source of randomness for everything that rolls dice: a python generator for single rolls and a numpy generator for batches.
+    Both are seeded from one numpy SeedSequence, so RNG(seed) replays exactly, and spawn() hands out statistically independent child streams for threads or processes.
+    Pass one to the rolling functions directly, or make it the default for a block of code with use_rng.
+    """
+
+    def __init__(self, seed: Union[int, np.random.SeedSequence, None] = None):
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+        python_seed, numpy_seed = self.seed_sequence.spawn(2)
+        self.random = random.Random(
+            int.from_bytes(python_seed.generate_state(4).tobytes(), "little")
+        )
+        self.generator = np.random.default_rng(numpy_seed)
+
+    def spawn(self, n: int) -> list["RNG"]:
+        return [RNG(seed_sequence) for seed_sequence in self.seed_sequence.spawn(n)]
+
+
+class _GlobalRNG(RNG):
+    # what you get when no RNG was given: the random module itself, so random.seed keeps working like it always has
+    def __init__(self):
+        self.seed_sequence = np.random.SeedSequence()
+        self.random = random  # type: ignore
+        self.generator = np.random.default_rng(self.seed_sequence.spawn(1)[0])
+
+
+_current_rng: ContextVar[RNG] = ContextVar("current_rng", default=_GlobalRNG())
+
+
+def get_rng(rng: Optional[RNG] = None) -> RNG:
+    """Returns rng if one was passed, otherwise the RNG set by use_rng (or the global one)."""
+    return rng if rng is not None else _current_rng.get()
+
+
+@contextmanager
+def use_rng(rng: Union[RNG, int, None] = None):
+    """Every roll inside the with block (in the current thread) comes from rng, unless a call is given its own.
+    An int (or None) is turned into a fresh RNG(rng) first. Yields the RNG in use."""
+    if not isinstance(rng, RNG):
+        rng = RNG(rng)
+    token = _current_rng.set(rng)
+    try:
+        yield rng
+    finally:
+        _current_rng.reset(token)
 
 
 def all_rolls(
@@ -23,6 +77,12 @@ def all_rolls(
     If 'all', all possible combinations that resulted in that roll.
     If 'count' a count of how many distinct combinations there are.
     If 'probabilities', the probability of the result."""
+    if result_type in ("counts", "probabilities"):
+        # no need to enumerate every combination just to count them
+        distribution: dict[int, Union[int, float, list[tuple[int]]]] = dict(
+            sum_distribution(dice, result_type)
+        )
+        return distribution
     dice_ranges = [range(1, die + 1) for die in dice]
     all_rolls: dict = {}
 
@@ -33,15 +93,91 @@ def all_rolls(
             all_rolls[sum(i)] = [i]
     if result_type == "all":
         return all_rolls
-    elif result_type == "counts":
-        return {i: len(all_rolls[i]) for i in all_rolls}
-    elif result_type == "probabilities":
-        roll_counts = {i: len(all_rolls[i]) for i in all_rolls}
-        return {i: roll_counts[i] / sum(roll_counts.values()) for i in roll_counts}
     else:
         raise Exception("Invalid result_type passed.")
 
 
+def _add_die(counts: list[int], faces: int) -> list[int]:
+    # convolving with a uniform die is just a sliding window sum over the previous counts
+    result = []
+    window = 0
+    for i in range(len(counts) + faces - 1):
+        if i < len(counts):
+            window += counts[i]
+        if i >= faces:
+            window -= counts[i - faces]
+        result.append(window)
+    return result
+
+
+def _normal_probabilities(dice: list, modifier: int = 0) -> dict[int, float]:
+    mean = sum((die + 1) / 2 for die in dice) + modifier
+    sd = math.sqrt(sum((die**2 - 1) / 12 for die in dice))
+
+    def phi(x: float) -> float:
+        return 0.5 * (1 + math.erf((x - mean) / (sd * math.sqrt(2))))
+
+    low, high = len(dice) + modifier, sum(dice) + modifier
+    if sd == 0:
+        return {low: 1.0}
+    # continuity correction, with the tails folded into the end points so it sums to 1
+    return {
+        total: (1.0 if total == high else phi(total + 0.5))
+        - (0.0 if total == low else phi(total - 0.5))
+        for total in range(low, high + 1)
+    }
+
+
+def sum_distribution(
+    dice: list,
+    result_type: str = "counts",
+    modifier: int = 0,
+    method: str = "exact",
+) -> dict[int, Union[int, float]]:
+    """Distribution of the total of a pool of dice, built by convolving one die at a time instead of enumerating rolls.
+    Dice are represented the same way as in all_rolls, and can be mixed sizes. modifier is added to every total.
+    Returns the same shape as all_rolls with result_type 'counts' or 'probabilities', keys in ascending order.
+    method 'exact' uses integer counts, so it is exact for any pool size (50d6 is a few milliseconds).
+    method 'normal' is a normal approximation for truly huge pools, and only supports 'probabilities'.
+    """
+    if result_type not in ("counts", "probabilities"):
+        raise Exception("Invalid result_type passed.")
+    if method == "normal":
+        if result_type != "probabilities":
+            raise ValueError("The normal approximation only supports 'probabilities'.")
+        return _normal_probabilities(dice, modifier)
+    elif method != "exact":
+        raise ValueError("method must be either 'exact' or 'normal'.")
+    counts = [1]
+    offset = modifier
+    for die in dice:
+        if die < 1:
+            return {}  # same as all_rolls, a die with no faces has no outcomes
+        counts = _add_die(counts, die)
+        offset += 1
+    if result_type == "counts":
+        return {i + offset: count for i, count in enumerate(counts)}
+    total = sum(counts)
+    return {i + offset: count / total for i, count in enumerate(counts)}
+
+
+def weighted_multisets(dice: list):
+    """Yields every distinct roll of identical dice as a sorted tuple, along with how many ordered rolls it stands for.
+    Dice are represented the same way as in all_rolls, but all need to be the same size.
+    The weights (multinomial coefficients) sum to the number of ordered rolls, so counting over these matches counting over all_rolls.
+    """
+    if len(set(dice)) > 1:
+        raise ValueError("weighted_multisets only supports dice of a single size.")
+    factorials = [math.factorial(i) for i in range(len(dice) + 1)]
+    faces = range(1, (dice[0] if dice else 1) + 1)
+    for rolled in itertools.combinations_with_replacement(faces, len(dice)):
+        weight = factorials[-1]
+        for face in faces:
+            weight //= factorials[rolled.count(face)]
+        yield rolled, weight
+
+
+@dc.disk_cache
 def check_conditions(adv_range: int = 3, passing_value: int = 7):
     if passing_value < 2 or passing_value > 12:
         raise ValueError(
@@ -50,17 +186,18 @@ def check_conditions(adv_range: int = 3, passing_value: int = 7):
 
     @cache
     def condition_test(rolled: tuple) -> tuple[bool, bool, bool, bool, bool]:
+        # rolled is always sorted, so the second highest die is rolled[-2]
         pm, phc, m, hc, fc = False, False, False, False, False
-        counts = Counter(rolled)
-        if counts[6] >= 1:
+        sixes = rolled.count(6)
+        if sixes >= 1:
             hc = True
-            if counts[6] >= 2:
+            if sixes >= 2:
                 fc = True
                 phc = True
-            elif heapq.nlargest(2, rolled)[-1] + 6 >= passing_value:
+            elif rolled[-2] + 6 >= passing_value:
                 phc = True
-        for number, count in counts.items():
-            if count >= 2 and number != 1:  # total failures dont count as matching!
+        for number in range(2, 7):  # total failures (1s) dont count as matching!
+            if rolled.count(number) >= 2:
                 m = True
                 if number * 2 >= passing_value:
                     pm = True
@@ -78,6 +215,8 @@ def check_conditions(adv_range: int = 3, passing_value: int = 7):
     }
 
     for dice in range(2, 3 + adv_range):
+        # every ordering of a multiset meets the same conditions, so each sorted roll stands in for all of its orderings
+        rolls = list(weighted_multisets([6] * dice))
         res["adv_level"].append(dice - 2)
         res["total_rolls"].append(6**dice)
         res["passing_matching"].append(0)
@@ -85,18 +224,15 @@ def check_conditions(adv_range: int = 3, passing_value: int = 7):
         res["matching"].append(0)
         res["halfcrit"].append(0)
         res["fullcrit"].append(0)
-        rolls = all_rolls([6] * dice)
-
-        for k, v in rolls.items():
-            for rolled in v:
-                # advantage
-                # gotta cast to tuple so its hashable...
-                pm, phc, m, hc, fc = condition_test(tuple(rolled))
-                res["passing_matching"][-1] += pm
-                res["passing_halfcrit"][-1] += phc
-                res["matching"][-1] += m
-                res["halfcrit"][-1] += hc
-                res["fullcrit"][-1] += fc
+
+        for rolled, weight in rolls:
+            # advantage
+            pm, phc, m, hc, fc = condition_test(rolled)
+            res["passing_matching"][-1] += pm * weight
+            res["passing_halfcrit"][-1] += phc * weight
+            res["matching"][-1] += m * weight
+            res["halfcrit"][-1] += hc * weight
+            res["fullcrit"][-1] += fc * weight
 
         if dice == 2:
             continue
@@ -108,17 +244,15 @@ def check_conditions(adv_range: int = 3, passing_value: int = 7):
         res["matching"].append(0)
         res["halfcrit"].append(0)
         res["fullcrit"].append(0)
-        rolls = all_rolls([6] * dice)
-
-        for k, v in rolls.items():
-            for rolled in v:
-                # disadvantage
-                pm, phc, m, hc, fc = condition_test(tuple(heapq.nsmallest(2, rolled)))
-                res["passing_matching"][-1] += pm
-                res["passing_halfcrit"][-1] += phc
-                res["matching"][-1] += m
-                res["halfcrit"][-1] += hc
-                res["fullcrit"][-1] += fc
+
+        for rolled, weight in rolls:
+            # disadvantage, rolled is sorted so the lowest two are up front
+            pm, phc, m, hc, fc = condition_test(rolled[:2])
+            res["passing_matching"][-1] += pm * weight
+            res["passing_halfcrit"][-1] += phc * weight
+            res["matching"][-1] += m * weight
+            res["halfcrit"][-1] += hc * weight
+            res["fullcrit"][-1] += fc * weight
 
     df = pd.DataFrame(res)
     df = df.sort_values(by="adv_level", ascending=False)
@@ -130,27 +264,200 @@ def check_conditions(adv_range: int = 3, passing_value: int = 7):
     return df
 
 
-def roll_on_table(entity: ty.Entity, curly: ty.Curly, bound_roll: bool = True) -> str:
+def compile_table(table: ty.Table) -> ty.Table:
+    """Adds the sorted outcome intervals roll_on_table looks rolls up in, and a default roll (1d the highest outcome) if there isn't one.
+    Outcome keys are either single numbers or ranges like "1-1000", and the intervals take one entry per key, however wide the range.
+    """
+    rows = []
+    for k, v in table["outcomes"].items():
+        if type(k) == str and (match_k := re.search(r"(\d*)-(\d*)", k)) is not None:
+            start, end = match_k.groups()
+            rows.append((int(start), int(end), v))
+        else:
+            rows.append((int(k), int(k), v))
+    rows.sort(key=lambda row: row[0])
+    for (start, end, _), (next_start, _, _) in zip(rows, rows[1:]):
+        if end >= next_start:
+            raise ValueError(
+                f"Table outcomes {start}-{end} and {next_start} overlap in {table['outcomes']}."
+            )
+    table["intervals"] = ty.TableIntervals(
+        {
+            "starts": [row[0] for row in rows],
+            "ends": [row[1] for row in rows],
+            "outcomes": [row[2] for row in rows],
+        }
+    )
+    if "roll" not in table.keys():
+        table["roll"] = "1d" + str(table["intervals"]["ends"][-1])
+    try:
+        row_probabilities = table_row_probabilities(table)
+    except (ValueError, TypeError):
+        # a roll that isn't dice ("special") only fails when someone rolls on the table, not the whole build
+        row_probabilities = None
+    if row_probabilities is not None:
+        table["sampler"] = build_alias_table(row_probabilities)
+    return table
+
+
+def table_row_probabilities(
+    table: ty.Table, roll: Optional[str] = None
+) -> Optional[list[float]]:
+    """Exact chance of landing on each row of a compiled table, with rolls outside the table bound to it like roll_on_table does.
+    roll defaults to the table's own. Returns None if the roll can land in a gap between rows, or there is no roll.
+    """
+    intervals = table["intervals"]
+    roll = roll or table.get("roll")
+    if roll is None:
+        return None
+    stats = dice_stats(roll)
+    row_probabilities = [0.0] * len(intervals["starts"])
+    for value, probability in stats["pmf"].items():
+        value = max(intervals["starts"][0], min(value, intervals["ends"][-1]))
+        index = bisect.bisect_right(intervals["starts"], value) - 1
+        if value > intervals["ends"][index]:
+            return None
+        row_probabilities[index] += probability
+    # whatever an exploding roll's cut off tail holds is past the top of the table
+    row_probabilities[-1] += stats["truncated_mass"]
+    return row_probabilities
+
+
+def build_alias_table(probabilities: list[float]) -> ty.AliasTable:
+    """Vose's alias method: turns a discrete distribution into a table that can be sampled in O(1) with a single uniform draw.
+    Probabilities are normalized, so weights work too.
+    """
+    n = len(probabilities)
+    total = sum(probabilities)
+    scaled = [p * n / total for p in probabilities]
+    thresholds = [1.0] * n
+    aliases = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        thresholds[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] -= 1 - scaled[less]
+        (small if scaled[more] < 1 else large).append(more)
+    # anything left over is 1 up to float error, so it keeps its own column
+    return ty.AliasTable(
+        {"probabilities": probabilities, "thresholds": thresholds, "aliases": aliases}
+    )
+
+
+def alias_sample(alias_table: ty.AliasTable, rng: Optional[RNG] = None) -> int:
+    u = get_rng(rng).random.random() * len(alias_table["thresholds"])
+    column = int(u)
+    if u - column < alias_table["thresholds"][column]:
+        return column
+    return alias_table["aliases"][column]
+
+
+def alias_sample_many(
+    alias_table: ty.AliasTable, n: int, rng: Optional[RNG] = None
+) -> np.ndarray:
+    u = get_rng(rng).generator.random(n) * len(alias_table["thresholds"])
+    columns = u.astype(np.int64)
+    return np.where(
+        u - columns < np.asarray(alias_table["thresholds"])[columns],
+        columns,
+        np.asarray(alias_table["aliases"])[columns],
+    )
+
+
+@lru_cache(maxsize=1024)
+def _alias_table_for(
+    roll: str, starts: tuple[int, ...], ends: tuple[int, ...]
+) -> Optional[ty.AliasTable]:
+    table = ty.Table(
+        {
+            "roll": roll,
+            "intervals": {"starts": list(starts), "ends": list(ends), "outcomes": []},
+        }
+    )
+    row_probabilities = table_row_probabilities(table)
+    return None if row_probabilities is None else build_alias_table(row_probabilities)
+
+
+def _table_lookup(intervals: ty.TableIntervals, roll: int) -> str:
+    index = bisect.bisect_right(intervals["starts"], roll) - 1
+    if index < 0 or roll > intervals["ends"][index]:
+        raise KeyError(str(roll))  # a gap in the table
+    return intervals["outcomes"][index]
+
+
+def roll_on_table(
+    entity: ty.Entity,
+    curly: ty.Curly,
+    bound_roll: bool = True,
+    rng: Optional[RNG] = None,
+) -> str:
     # bound_roll means that if the roll is lower than min, it becomes min, if it is higher than max, it becomes max
     table = entity["table"]
-    roll_min = int(min(table["expanded_outcomes"].keys()))
-    roll_max = int(max(table["expanded_outcomes"].keys()))
+    intervals = table["intervals"]
+    roll_min = intervals["starts"][0]
+    roll_max = intervals["ends"][-1]
     if curly["table_dice"]:
         roll = curly["table_result"]
-    elif "roll" in table.keys():
-        roll = die_parser_roller((table["roll"]))
+        if roll is None:  # a compiled curly, its table dice haven't been rolled yet
+            roll = die_parser_roller(curly["table_dice"], rng)
+    elif bound_roll and "sampler" in table.keys():
+        # same distribution as rolling table["roll"] and looking it up, in one draw
+        return intervals["outcomes"][alias_sample(table["sampler"], rng)]
+    elif (table_roll := table.get("roll")) is not None:
+        roll = die_parser_roller(table_roll, rng)
     else:
-        roll = randint(
+        roll = get_rng(rng).random.randint(
             roll_min,
             roll_max,
         )
     if bound_roll:
         roll = max(roll_min, min(roll, roll_max))
-    # doesnt seem like the preprocess buys as much as i thought it might!
-    return table["expanded_outcomes"][str(roll)]
+    return _table_lookup(intervals, roll)
+
+
+def roll_on_table_many(
+    entity: ty.Entity,
+    n: int,
+    curly: Optional[ty.Curly] = None,
+    bound_roll: bool = True,
+    rng: Optional[RNG] = None,
+) -> list[str]:
+    """Rolls on entity's table n times at once, following roll_on_table.
+    If curly has table dice, those are rolled n times instead of the table's own roll.
+    """
+    table = entity["table"]
+    intervals = table["intervals"]
+    dice = (curly["table_dice"] if curly is not None else "") or table.get("roll")
+    if dice is None:
+        # like roll_on_table, every roll from the first row to the last is as likely
+        rolls = get_rng(rng).generator.integers(
+            intervals["starts"][0], intervals["ends"][-1], n, endpoint=True
+        )
+    else:
+        if bound_roll:
+            if dice == table.get("roll") and "sampler" in table.keys():
+                alias_table: Optional[ty.AliasTable] = table["sampler"]
+            else:
+                alias_table = _alias_table_for(
+                    dice, tuple(intervals["starts"]), tuple(intervals["ends"])
+                )
+            if alias_table is not None:
+                rows = alias_sample_many(alias_table, n, rng).tolist()
+                return [intervals["outcomes"][i] for i in rows]
+        rolls = die_parser_roller_batch(dice, n, rng)
+    if bound_roll:
+        rolls = np.clip(rolls, intervals["starts"][0], intervals["ends"][-1])
+    indices = np.searchsorted(intervals["starts"], rolls, side="right") - 1
+    gaps = (indices < 0) | (rolls > np.asarray(intervals["ends"])[indices])
+    if gaps.any():
+        raise KeyError(str(rolls[gaps][0]))
+    return [intervals["outcomes"][i] for i in indices.tolist()]
 
 
 def get_ev(dice: list, mod="") -> float:
+    """Quick expected values for a few special cases. dice_stats handles any dice expression, and gives more than the mean."""
     if mod == "":
         return float(sum(dice) / len(dice) + (len(dice) * 0.5))
     elif mod == "double_on_max":
@@ -193,39 +500,254 @@ std_check_probabilities = {
 }
 
 
-def get_pass_probability(score: int, dc: int) -> float:
-    cum_prob = score_adjustment(
-        get_cumulative_probability(std_check_probabilities), score
+def check_counts(adv_level: int = 0) -> dict[int, int]:
+    """Counts of each 2d6 check total at an advantage level, out of 6 ** (2 + abs(adv_level)) rolls.
+    Advantage rolls 2 + adv_level dice and keeps the highest two, disadvantage (negative adv_level) keeps the lowest two.
+    """
+    counts: dict = {}
+    for rolled, weight in weighted_multisets([6] * (2 + abs(adv_level))):
+        kept = sum(rolled[-2:] if adv_level >= 0 else rolled[:2])
+        counts[kept] = counts.get(kept, 0) + weight
+    return dict(sorted(counts.items()))
+
+
+@cache
+def _pass_surface(adv_level: int) -> tuple[int, np.ndarray]:
+    # survival[i] is the chance of rolling at least lowest + i; the trailing 0.0 covers anything past the highest roll
+    counts = check_counts(adv_level)
+    total = 6 ** (2 + abs(adv_level))
+    lowest, highest = min(counts), max(counts)
+    # summing the integer counts first keeps these exact, unlike 1 - a running float sum
+    survival = [
+        sum(counts.get(roll, 0) for roll in range(target, highest + 1)) / total
+        for target in range(lowest, highest + 2)
+    ]
+    return lowest, np.array(survival)
+
+
+def pass_probability(scores, dcs, adv_levels=0) -> np.ndarray:
+    """Chance that a 2d6 check plus score meets or beats dc, for every score, dc and advantage level at once.
+    Arguments can be ints or arrays and broadcast like numpy arrays, so scores[:, None] and dcs[None, :] gives a whole score by dc grid.
+    """
+    scores, dcs, adv_levels = np.broadcast_arrays(
+        np.asarray(scores, dtype=np.int64),
+        np.asarray(dcs, dtype=np.int64),
+        np.asarray(adv_levels, dtype=np.int64),
     )
-    if max(cum_prob.keys()) < dc - 1:
-        return 0.0
-    elif min(cum_prob.keys()) > dc - 1:
-        return 1.0
-    else:
-        return 1 - cum_prob[dc - 1]
+    probabilities = np.empty(scores.shape)
+    for adv_level in np.unique(adv_levels):
+        lowest, survival = _pass_surface(int(adv_level))
+        level = adv_levels == adv_level
+        needed = dcs[level] - scores[level] - lowest
+        probabilities[level] = survival[np.clip(needed, 0, len(survival) - 1)]
+    return probabilities
+
+
+def required_dc(scores, target_probabilities, adv_levels=0) -> np.ndarray:
+    """The highest dc that a check with score still passes with at least the target probability.
+    The inverse of pass_probability, and broadcasts the same way. Targets need to be in (0, 1].
+    """
+    scores, targets, adv_levels = np.broadcast_arrays(
+        np.asarray(scores, dtype=np.int64),
+        np.asarray(target_probabilities, dtype=np.float64),
+        np.asarray(adv_levels, dtype=np.int64),
+    )
+    if ((targets <= 0) | (targets > 1)).any():
+        raise ValueError("target_probabilities need to be in (0, 1].")
+    dcs = np.empty(scores.shape, dtype=np.int64)
+    for adv_level in np.unique(adv_levels):
+        lowest, survival = _pass_surface(int(adv_level))
+        level = adv_levels == adv_level
+        # survival only goes down, so count how many targets still clear the bar
+        reachable = np.searchsorted(-survival, -targets[level], side="right")
+        dcs[level] = scores[level] + lowest + reachable - 1
+    return dcs
+
+
+def get_pass_probability(score: int, dc: int, adv_level: int = 0) -> float:
+    return float(pass_probability(score, dc, adv_level))
+
+
+def _die_probabilities(faces: int, explode: bool, limit: int) -> list[float]:
+    # probabilities of a single die's total for every value from 0 up to limit (inclusive)
+    probabilities = [0.0] * (limit + 1)
+    if not explode or faces == 1:
+        for value in range(1, min(faces, limit) + 1):
+            probabilities[value] = 1 / faces
+        return probabilities
+    # an exploding die totals k * faces + r (r < faces) after k maxed rolls, with probability faces^-(k+1)
+    for value in range(1, limit + 1):
+        if value % faces:
+            probabilities[value] = faces ** -(value // faces + 1)
+    return probabilities
+
+
+@dataclass(frozen=True)
+class DiceExpression:
+    """A dice expression like "2d6x+1", parsed once. Get these from compile_dice rather than building them by hand."""
 
+    quantity: int
+    faces: int
+    explode: bool
+    modifier: int
 
-def die_parser_roller(curly_match: str) -> int:
+    @property
+    def exploding(self) -> bool:
+        # a d1 never explodes, it would never stop
+        return self.explode and self.faces > 1
+
+    def roll(self, rng: Optional[RNG] = None) -> int:
+        randint = get_rng(rng).random.randint
+        roll = 0
+        for i in range(0, self.quantity):
+            just_rolled = randint(1, self.faces)
+            if self.exploding:
+                while just_rolled == self.faces:
+                    roll += just_rolled
+                    just_rolled = randint(1, self.faces)
+            roll += just_rolled
+        roll += self.modifier
+        return max(
+            roll, 0
+        )  # Here following the ttrpg convention that you cannot roll a negative number.
+
+    def roll_many(self, n: int, rng: Optional[RNG] = None) -> np.ndarray:
+        """Rolls the expression n times at once, returning an int array of the n results."""
+        generator = get_rng(rng).generator
+        rolled = generator.integers(1, self.faces + 1, size=(n, self.quantity))
+        rolls = rolled.sum(axis=1)
+        if self.exploding:
+            # each pass rerolls only the dice that just came up max, until none are left
+            exploding = (rolled == self.faces).sum(axis=1)
+            while exploding.any():
+                owners = np.repeat(np.arange(n), exploding)
+                rerolled = generator.integers(1, self.faces + 1, size=len(owners))
+                rolls += np.bincount(owners, weights=rerolled, minlength=n).astype(
+                    np.int64
+                )
+                exploding = np.bincount(
+                    owners, weights=rerolled == self.faces, minlength=n
+                )
+                exploding = exploding.astype(np.int64)
+        return np.maximum(rolls + self.modifier, 0)
+
+    @property
+    def min(self) -> int:
+        return max(self.quantity + self.modifier, 0)
+
+    @property
+    def max(self) -> Union[int, float]:
+        if self.exploding:
+            return math.inf
+        return max(self.quantity * self.faces + self.modifier, 0)
+
+    @property
+    def mean(self) -> float:
+        if self.exploding:
+            die_mean = self.faces * (self.faces + 1) / (2 * (self.faces - 1))
+        else:
+            die_mean = (self.faces + 1) / 2
+        mean = self.quantity * die_mean + self.modifier
+        if self.quantity + self.modifier >= 0:
+            return mean
+        # the floor at zero kicks in, so add back what the totals below zero took away
+        limit = -self.modifier
+        probabilities = [1.0] + [0.0] * limit
+        die = _die_probabilities(self.faces, self.explode, limit)
+        for i in range(self.quantity):
+            probabilities = [
+                sum(probabilities[j] * die[total - j] for j in range(total + 1))
+                for total in range(limit + 1)
+            ]
+        return mean + sum(
+            probability * (limit - total)
+            for total, probability in enumerate(probabilities)
+        )
+
+
+@lru_cache(maxsize=1024)
+def compile_dice(curly_match: str) -> DiceExpression:
+    """Parses the first dice expression in curly_match. Results are cached, so calling this in a hot loop is cheap."""
     if result := re.search(r"(\d*)d(\d+)(x?)([-+]?\d*)", curly_match):
         quantity, top_face, x, mod = result.groups()
-    assert top_face
-    top_face = int(top_face)
-    if not quantity:
-        quantity = 1
-    else:
-        quantity = int(quantity)
-    roll = 0
-    for i in range(0, quantity):
-        just_rolled = random.randint(1, top_face)
-        if x and top_face > 1:
-            while just_rolled == top_face:
-                roll += just_rolled
-                just_rolled = random.randint(1, top_face)
-        roll += just_rolled
-    if not mod:
-        pass
+        return DiceExpression(
+            quantity=int(quantity) if quantity else 1,
+            faces=int(top_face),
+            explode=bool(x),
+            modifier=int(mod or 0),
+        )
+    raise ValueError(f"No dice expression found in {curly_match!r}.")
+
+
+def die_parser_roller(curly_match: str, rng: Optional[RNG] = None) -> int:
+    return compile_dice(curly_match).roll(rng)
+
+
+def die_parser_roller_batch(
+    curly_match: str, n: int, rng: Optional[RNG] = None
+) -> np.ndarray:
+    """Rolls the same dice expression n times at once, returning an int array of the n results.
+    Follows die_parser_roller exactly, exploding dice and the floor at zero included, without a python loop per roll.
+    """
+    return compile_dice(curly_match).roll_many(n, rng)
+
+
+@lru_cache(maxsize=1024)
+def _dice_pmf(
+    curly_match: str, tolerance: float
+) -> tuple[tuple[int, ...], tuple[float, ...]]:
+    dice = compile_dice(curly_match)
+    if dice.exploding:
+        # a die explodes at least depth times with probability faces^-depth, so go deep enough that all the chopped off tails together are under tolerance
+        depth = 1
+        while dice.quantity * dice.faces**-depth > tolerance:
+            depth += 1
+        limit = depth * dice.faces
     else:
-        roll += int(mod)
-    return max(
-        roll, 0
-    )  # Here following the ttrpg convention that you cannot roll a negative number.
+        limit = dice.faces
+    die = np.array(_die_probabilities(dice.faces, dice.explode, limit))
+    probabilities = np.array([1.0])
+    for i in range(dice.quantity):
+        probabilities = np.convolve(probabilities, die)
+    values = np.arange(len(probabilities)) + dice.modifier
+    # the floor at zero piles everything below it onto zero
+    if values[0] < 0:
+        floored = np.zeros(max(values[-1], 0) + 1)
+        floored[0] = probabilities[values <= 0].sum()
+        floored[1:] = probabilities[values > 0]
+        values, probabilities = np.arange(len(floored)), floored
+    possible = probabilities > 0
+    return tuple(values[possible].tolist()), tuple(probabilities[possible].tolist())
+
+
+def dice_stats(curly_match: str, tolerance: float = 1e-12) -> ty.DiceStats:
+    """Exact statistics for any dice expression die_parser_roller understands, floor at zero included.
+    Exploding dice have an infinite tail, which is cut off once the probability left in it is under tolerance (reported as truncated_mass).
+    The underlying distribution is memoized per expression, so repeated calls are instant.
+    """
+    values, probabilities = _dice_pmf(curly_match, tolerance)
+    mean = sum(v * p for v, p in zip(values, probabilities))
+    variance = sum((v - mean) ** 2 * p for v, p in zip(values, probabilities))
+    third = sum((v - mean) ** 3 * p for v, p in zip(values, probabilities))
+    return ty.DiceStats(
+        {
+            "expression": curly_match,
+            "mean": mean,
+            "variance": variance,
+            "skew": third / variance**1.5 if variance > 0 else 0.0,
+            "pmf": dict(zip(values, probabilities)),
+            "cdf": dict(zip(values, itertools.accumulate(probabilities))),
+            "truncated_mass": max(1 - sum(probabilities), 0.0),
+        }
+    )
+
+
+def dice_quantile(curly_match: str, q, tolerance: float = 1e-12):
+    """The smallest result whose cumulative probability reaches q. q can be a float or an array of them."""
+    values, probabilities = _dice_pmf(curly_match, tolerance)
+    cumulative = np.cumsum(probabilities)
+    indices = np.minimum(
+        np.searchsorted(cumulative, np.asarray(q) - 1e-12), len(values) - 1
+    )
+    quantiles = np.asarray(values)[indices]
+    return int(quantiles) if quantiles.ndim == 0 else quantiles
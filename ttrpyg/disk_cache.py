@@ -0,0 +1,120 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+from importlib import metadata
+from typing import Optional
+
+# A persistent results cache for the expensive probability tables, so they survive between notebook sessions and report runs.
+# Entries are keyed by function name, arguments, library version and the source of the function's module,
+# so upgrading ttrpyg (or editing the function) never serves stale tables.
+# TTRPYG_CACHE_DIR moves the cache (default ~/.cache/ttrpyg), TTRPYG_CACHE_MAX_BYTES bounds its size (default 256MB),
+# and TTRPYG_DISK_CACHE=0 turns it off. Past the size bound the least recently used entries are evicted.
+
+try:
+    version = metadata.version("ttrpyg")
+except metadata.PackageNotFoundError:
+    version = "0.1"
+
+
+def get_cache_dir() -> str:
+    return os.environ.get(
+        "TTRPYG_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ttrpyg")
+    )
+
+
+@functools.lru_cache
+def _source_hash(path: Optional[str]) -> str:
+    # the whole module, the cached function's helpers can change too
+    try:
+        with open(path, "rb") as f:  # type: ignore
+            return hashlib.sha256(f.read()).hexdigest()
+    except (OSError, TypeError):
+        return ""
+
+
+def _entry_path(func, args: tuple, kwargs: dict) -> str:
+    # binding first means f(3) and f(adv_range=3) share an entry
+    bound = inspect.signature(func).bind(*args, **kwargs)
+    bound.apply_defaults()
+    key = pickle.dumps(
+        (
+            func.__module__,
+            func.__qualname__,
+            list(bound.arguments.items()),
+            version,
+            _source_hash(inspect.getsourcefile(func)),
+        )
+    )
+    return os.path.join(
+        get_cache_dir(),
+        f"{func.__qualname__}-{hashlib.sha256(key).hexdigest()}.pickle",
+    )
+
+
+def evict(max_bytes: Optional[int] = None) -> None:
+    """Deletes least recently used entries until the cache is under max_bytes."""
+    if max_bytes is None:
+        max_bytes = int(os.environ.get("TTRPYG_CACHE_MAX_BYTES", 256 * 1024**2))
+    cache_dir = get_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".pickle"):
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:  # someone else evicted it first
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear() -> None:
+    evict(0)
+
+
+def disk_cache(func):
+    """Decorator that keeps func's results on disk. Arguments need to be picklable, results too.
+    Reads bump an entry's mtime, which is what eviction goes by. Writes are atomic, so concurrent processes are fine.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if os.environ.get("TTRPYG_DISK_CACHE", "1") == "0":
+            return func(*args, **kwargs)
+        path = _entry_path(func, args, kwargs)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            os.utime(path)
+            return result
+        except (
+            OSError,
+            pickle.UnpicklingError,
+            EOFError,
+            AttributeError,
+            ImportError,
+        ):
+            pass  # not cached yet, a broken entry or one pickled by other library versions, so just compute it
+        result = func(*args, **kwargs)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+        evict()
+        return result
+
+    return wrapper
@@ -10,10 +10,24 @@ class Curly(TypedDict):
     table_result: Union[int, None]
 
 
+class TableIntervals(TypedDict):
+    # sorted and non-overlapping, outcomes[i] covers rolls starts[i] to ends[i] (inclusive)
+    starts: list[int]
+    ends: list[int]
+    outcomes: list[str]
+
+
+class AliasTable(TypedDict):
+    probabilities: list[float]
+    thresholds: list[float]
+    aliases: list[int]
+
+
 class Table(TypedDict, total=False):
     roll: Optional[str]
     outcomes: dict[Union[int, str], str]  # required
-    expanded_outcomes: dict[int, str]
+    intervals: TableIntervals
+    sampler: AliasTable  # the rows' exact chances under roll, ready for alias sampling
 
 
 class Entity(TypedDict, total=False):
@@ -71,6 +85,15 @@ class NonUniqueEntity(TypedDict):
 NonUniqueEntities = NewType("NonUniqueEntities", dict[str, NonUniqueEntity])
 
 
+class Reference(TypedDict):
+    source: str
+    target: str
+    curly: Curly  # as compiled, so quantity and table_result are only set when they are fixed
+    row: Optional[
+        int
+    ]  # the row of the source's table it is in, None when it is outside the table
+
+
 class TreeEntry(TypedDict):
     id: int
     entity: str
@@ -78,11 +101,62 @@ class TreeEntry(TypedDict):
     unique: bool
     text: str
     curly: Curly
+    parent: Optional[int]
+    depth: int
 
 
 EntityTree = NewType("EntityTree", list[TreeEntry])
 
 
+class EntityExpansion(TypedDict):
+    tree: EntityTree
+    nodes: int  # len(tree), except when streaming, when the tree isn't kept
+    non_unique: NonUniqueEntities
+    truncated: bool
+    reason: Optional[
+        str
+    ]  # the budget that cut the tree short: "max_nodes", "max_depth" or "time_budget"
+    cycles: list[
+        list[str]
+    ]  # clean_names from the base down to an entity that holds one of its ancestors
+
+
+class DiceStats(TypedDict):
+    expression: str
+    mean: float
+    variance: float
+    skew: float
+    pmf: dict[int, float]
+    cdf: dict[int, float]
+    truncated_mass: float
+
+
+class SimulationResult(TypedDict):
+    trials: int
+    mean: float
+    variance: float
+    std_error: float
+    confidence_interval: tuple[float, float]
+    percentiles: dict[int, int]
+    histogram: dict[int, int]
+    converged: bool
+
+
+class ManifestFile(TypedDict):
+    mtime_ns: int
+    size: int
+    sha256: str
+    keys: list[str]  # the file's top level keys
+    doc_ids: list[int]  # the documents that came out of it
+
+
+class Manifest(TypedDict):
+    version: int
+    input_path: str
+    db_sha256: str  # of the output_path it goes with
+    files: dict[str, ManifestFile]  # by path relative to input_path
+
+
 ## The next types are from the old doc-generation workflow which will be removed soon.
 
 
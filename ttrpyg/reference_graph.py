@@ -0,0 +1,267 @@
+import bisect
+import math
+from typing import Optional
+
+import ttrpyg.my_types as ty
+import ttrpyg.text as tx
+import ttrpyg.dice_utils as du
+
+# Which entities hold which, read off the curlies in their text once, when the catalog is built.
+# That way "who references X", "what can X turn into" and "how big can X get" don't need any rendering,
+# and a reference to an entity that isn't in the catalog shows up at build time instead of mid-render.
+
+# the fields the tree expander sees of an entity (md, without the full text), tables are read row by row
+reference_fields = [
+    k
+    for k in tx.key_order
+    if k not in ("clean_name", "meta_tags", "full_text", "table")
+]
+
+
+def get_references(entity: ty.Entity) -> list[ty.Reference]:
+    """The curlies in entity that point at another entity, in the order the tree expander meets them."""
+    texts: list[tuple[object, Optional[int]]] = []  # (text, table row)
+    for k in reference_fields:
+        if (v := entity.get(k)) is not None:
+            if type(v) == list:
+                texts += [(item, None) for item in v]
+            else:
+                texts.append((v, None))
+    if "table" in entity:
+        outcomes = entity["table"]["intervals"]["outcomes"]
+        texts += [(outcome, row) for row, outcome in enumerate(outcomes)]
+    references = []
+    for text, row in texts:
+        # most fields don't have any curlies, no need to run the regexes on them
+        if type(text) == str and "{" in text:
+            for curly in tx.compile_curlies(text):
+                if curly["entity"]:
+                    references.append(
+                        ty.Reference(
+                            {
+                                "source": entity["clean_name"],
+                                "target": curly["entity"],
+                                "curly": curly,
+                                "row": row,
+                            }
+                        )
+                    )
+    return references
+
+
+def max_quantity(curly: ty.Curly) -> float:
+    if curly["quantity_dice"]:
+        return du.compile_dice(curly["quantity_dice"]).max
+    return curly["quantity"]
+
+
+class ReferenceGraph:
+    def __init__(self) -> None:
+        """Entities (by clean_name) and the references between them. Keep it in step with add and remove."""
+        # clean_name -> its references, every entity has an entry, even if it holds nothing
+        self.references: dict[str, list[ty.Reference]] = {}
+        # clean_name -> (starts, ends, roll) of its table, for working out which rows a curly can land on
+        self.tables: dict[str, tuple[list[int], list[int], Optional[str]]] = {}
+        # clean_name -> the clean_names referencing it -> how many times
+        self.referrers: dict[str, dict[str, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.references)
+
+    def __contains__(self, clean_name: str) -> bool:
+        return clean_name in self.references
+
+    def add(self, entity: ty.Entity) -> None:
+        clean_name = entity["clean_name"]
+        self.remove(clean_name)
+        self.references[clean_name] = get_references(entity)
+        if "table" in entity.keys():
+            table = entity["table"]
+            self.tables[clean_name] = (
+                table["intervals"]["starts"],
+                table["intervals"]["ends"],
+                table["roll"],
+            )
+        for reference in self.references[clean_name]:
+            referrers = self.referrers.setdefault(reference["target"], {})
+            referrers[clean_name] = referrers.get(clean_name, 0) + 1
+
+    def remove(self, clean_name: str) -> None:
+        self.tables.pop(clean_name, None)
+        for reference in self.references.pop(clean_name, []):
+            referrers = self.referrers[reference["target"]]
+            referrers[clean_name] -= 1
+            if not referrers[clean_name]:
+                del referrers[clean_name]
+            if not referrers:
+                del self.referrers[reference["target"]]
+
+    def clear(self) -> None:
+        self.references.clear()
+        self.tables.clear()
+        self.referrers.clear()
+
+    def get_targets(self, clean_name: str) -> list[str]:
+        """The entities clean_name references, each once, in order."""
+        return list(
+            dict.fromkeys(
+                reference["target"] for reference in self.references[clean_name]
+            )
+        )
+
+    def referenced_by(self, clean_name: str) -> list[str]:
+        """The entities that reference clean_name, sorted. clean_name doesn't have to be in the catalog."""
+        return sorted(self.referrers.get(clean_name, {}))
+
+    def reachable(self, clean_name: str) -> set[str]:
+        """Every entity clean_name can (eventually) expand into. It's only in there itself if it is part of a cycle.
+        Missing entities it references are in there too, see dangling.
+        """
+        seen: set[str] = set()
+        stack = [clean_name]
+        while stack:
+            for target in self.get_targets(stack.pop()):
+                if target not in seen:
+                    seen.add(target)
+                    if target in self.references:
+                        stack.append(target)
+        return seen
+
+    def dangling(self) -> dict[str, list[str]]:
+        """Referenced clean_names that aren't in the catalog -> the entities referencing them (sorted)."""
+        return {
+            target: sorted(referrers)
+            for target, referrers in sorted(self.referrers.items())
+            if target not in self.references
+        }
+
+    def get_components(self) -> list[list[str]]:
+        """Tarjan's strongly connected components, each one comes before any it can reach."""
+        index: dict[str, int] = {}
+        low: dict[str, int] = {}
+        stack: list[str] = []
+        on_stack: set[str] = set()
+        components = []
+        for root in self.references:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            # a stack of (entity, the targets it has left to look at) instead of recursing, chains can be long
+            work = [(root, iter(self.get_targets(root)))]
+            while work:
+                node, targets = work[-1]
+                for target in targets:
+                    if target not in self.references:
+                        continue
+                    if target not in index:
+                        index[target] = low[target] = len(index)
+                        stack.append(target)
+                        on_stack.add(target)
+                        work.append((target, iter(self.get_targets(target))))
+                        break
+                    if target in on_stack:
+                        low[node] = min(low[node], index[target])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        components.append(component)
+        return components[::-1]
+
+    def cycles(self) -> list[list[str]]:
+        """One cycle for every group of entities that can hold each other, as clean_names from the group's first (alphabetically) back to itself.
+        Like the tree expander's cycles, so an entity holding itself is [name, name].
+        """
+        cycles = []
+        for component in self.get_components():
+            members = set(component)
+            start = min(component)
+            # a shortest way back to start, inside the group
+            parents: dict[str, str] = {}
+            frontier = [start]
+            while frontier and start not in parents:
+                next_frontier = []
+                for node in frontier:
+                    for target in self.get_targets(node):
+                        if target in members and target not in parents:
+                            parents[target] = node
+                            next_frontier.append(target)
+                frontier = next_frontier
+            if start not in parents:
+                continue  # a single entity that doesn't hold itself
+            cycle = [start]
+            node = parents[start]
+            while node != start:
+                cycle.append(node)
+                node = parents[node]
+            cycles.append([start, *cycle[:0:-1], start])
+        return sorted(cycles)
+
+    def get_rows(self, clean_name: str, curly: Optional[ty.Curly] = None) -> range:
+        """The rows of clean_name's table a curly (default one without table dice) can land on, bound to the table like roll_on_table does.
+        A table without a roll, or with one that isn't dice ("special"), can land on any of them.
+        """
+        if clean_name not in self.tables:
+            return range(0)
+        starts, ends, roll = self.tables[clean_name]
+        if curly is not None and curly["table_dice"]:
+            roll = curly["table_dice"]
+        if roll is None:
+            return range(len(starts))
+        try:
+            dice = du.compile_dice(roll)
+        except ValueError:
+            return range(len(starts))
+        low = max(starts[0], min(dice.min, ends[-1]))
+        high = max(starts[0], min(dice.max, ends[-1]))
+        return range(
+            bisect.bisect_right(starts, low) - 1, bisect.bisect_right(starts, high)
+        )
+
+    def max_expansion(self, clean_name: str, quantity: int = 1) -> float:
+        """The most nodes expand_entity_tree (rolling dice, without budgets) can make out of quantity clean_names, so max_nodes can be picked up front.
+        It's an upper bound: every quantity rolls its max and a table lands on whichever row it can reach that holds the most.
+        Exploding quantity dice, and cycles (the expander cuts them, but where depends on the path taken), make it math.inf.
+        """
+        sizes: dict[tuple[str, range], float] = {}
+        visiting: set[str] = set()
+
+        def get_size(name: str, rows: range) -> float:
+            if name not in self.references:
+                raise KeyError(f"{name} is not in the catalog.")
+            if (name, rows) in sizes:
+                return sizes[(name, rows)]
+            if name in visiting:
+                return math.inf
+            visiting.add(name)
+            body = 0.0
+            row_sizes = dict.fromkeys(rows, 0.0)
+            for reference in self.references[name]:
+                if (most := max_quantity(reference["curly"])) == 0:
+                    continue
+                size = most * get_size(
+                    reference["target"],
+                    self.get_rows(reference["target"], reference["curly"]),
+                )
+                if reference["row"] is None:
+                    body += size
+                elif reference["row"] in row_sizes:
+                    row_sizes[reference["row"]] += size
+            visiting.discard(name)
+            sizes[(name, rows)] = 1 + body + max(row_sizes.values(), default=0)
+            return sizes[(name, rows)]
+
+        if quantity == 0:
+            return 0
+        return quantity * get_size(clean_name, self.get_rows(clean_name))
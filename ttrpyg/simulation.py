@@ -0,0 +1,118 @@
+import os
+from collections import Counter
+from collections.abc import Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+from typing import Optional, Union
+
+import numpy as np
+
+import ttrpyg.my_types as ty
+import ttrpyg.dice_utils as du
+
+# Monte Carlo for the mechanics that don't have a closed form.
+# A roller is either a dice expression (anything die_parser_roller understands) or a function taking a du.RNG and returning an int.
+# Functions get sent to other processes, so they need to be picklable (defined at the top level of a module, not a lambda).
+
+Roller = Union[str, Callable[[du.RNG], int]]
+
+
+def _run_shard(roller: Roller, trials: int, rng: du.RNG) -> dict[int, int]:
+    if isinstance(roller, str):
+        values, counts = np.unique(
+            du.die_parser_roller_batch(roller, trials, rng), return_counts=True
+        )
+        return dict(zip(values.tolist(), counts.tolist()))
+    return dict(Counter(roller(rng) for i in range(trials)))
+
+
+def summarize_histogram(
+    histogram: dict[int, int],
+    confidence: float = 0.95,
+    percentiles: tuple = (5, 25, 50, 75, 95),
+) -> ty.SimulationResult:
+    """Turns a {result: count} histogram into summary statistics.
+    Percentiles are nearest-rank; the confidence interval is the normal interval around the mean.
+    """
+    values = np.array(sorted(histogram), dtype=np.float64)
+    counts = np.array([histogram[v] for v in sorted(histogram)], dtype=np.float64)
+    trials = int(counts.sum())
+    mean = float((values * counts).sum() / trials)
+    variance = (
+        float((counts * (values - mean) ** 2).sum() / (trials - 1))
+        if trials > 1
+        else 0.0
+    )
+    std_error = (variance / trials) ** 0.5
+    half_width = NormalDist().inv_cdf((1 + confidence) / 2) * std_error
+    cumulative = np.cumsum(counts)
+    return ty.SimulationResult(
+        {
+            "trials": trials,
+            "mean": mean,
+            "variance": variance,
+            "std_error": std_error,
+            "confidence_interval": (mean - half_width, mean + half_width),
+            "percentiles": {
+                p: int(values[np.searchsorted(cumulative, p / 100 * trials)])
+                for p in percentiles
+            },
+            "histogram": dict(sorted(histogram.items())),
+            "converged": False,
+        }
+    )
+
+
+def simulate(
+    roller: Roller,
+    trials: int = 100_000,
+    precision: Optional[float] = None,
+    confidence: float = 0.95,
+    percentiles: tuple = (5, 25, 50, 75, 95),
+    seed: Union[int, du.RNG, None] = None,
+    workers: Optional[int] = None,
+    shard_size: int = 10_000,
+) -> ty.SimulationResult:
+    """Rolls roller up to trials times, sharded across a process pool, and merges the histograms.
+    If precision is given, it stops as soon as the confidence interval on the mean is within +/- precision (converged is then True).
+    Each shard gets its own child stream of seed, so a seeded run with the same workers replays exactly.
+    workers=1 runs everything in this process, so does a run that fits in one shard, there's never more workers than shards.
+    """
+    rng = seed if isinstance(seed, du.RNG) else du.RNG(seed)
+    shards = [shard_size] * (trials // shard_size)
+    if trials % shard_size:
+        shards.append(trials % shard_size)
+    # starting a pool costs more than rolling a shard or two, don't start workers that would sit idle
+    workers = max(1, min(workers or os.cpu_count() or 1, len(shards)))
+    shard_rngs = rng.spawn(len(shards))
+    histogram: Counter = Counter()
+    result = None
+
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        # shards go out a round (one per worker) at a time, so precision can be checked in between
+        for start in range(0, len(shards), workers):
+            round_shards = shards[start : start + workers]
+            round_rngs = shard_rngs[start : start + workers]
+            round_histograms: Iterable[dict[int, int]]
+            if executor is None:
+                round_histograms = map(
+                    _run_shard, [roller] * len(round_shards), round_shards, round_rngs
+                )
+            else:
+                round_histograms = executor.map(
+                    _run_shard, [roller] * len(round_shards), round_shards, round_rngs
+                )
+            for shard_histogram in round_histograms:
+                histogram.update(shard_histogram)
+            result = summarize_histogram(histogram, confidence, percentiles)
+            low, high = result["confidence_interval"]
+            if precision is not None and (high - low) / 2 <= precision:
+                result["converged"] = True
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if result is None:
+        raise ValueError("simulate needs at least one trial.")
+    return result
@@ -0,0 +1,434 @@
+import json
+import os
+import sqlite3
+import tempfile
+from collections.abc import Iterable, Iterator
+from contextlib import closing
+from typing import Optional
+
+from tinydb.storages import MemoryStorage
+from tinydb.table import Document
+
+import ttrpyg.database as dt
+import ttrpyg.text as tx
+import ttrpyg.reference_graph as rg
+
+# The same catalog as DB, kept in a sqlite file instead of TinyDB's one big JSON document.
+# Entities are stored as JSON, side tables index clean_name and every field's values so lookups are index reads.
+# The file is never written in place: (re)builds go to a temporary file that is renamed over it,
+# so any number of processes can read it at once, and readers that already have it open keep a consistent catalog.
+
+# bump whenever the schema changes, older files get rebuilt
+schema_version = 1
+
+schema = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE files (key TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, sha256 TEXT NOT NULL);
+CREATE TABLE entities (
+    doc_id INTEGER PRIMARY KEY,
+    clean_name TEXT NOT NULL,
+    source TEXT NOT NULL REFERENCES files (key),
+    document TEXT NOT NULL
+);
+-- each field, as a list or not, with where it was first seen
+CREATE TABLE fields (
+    field TEXT NOT NULL,
+    is_list INTEGER NOT NULL,
+    first_doc_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (field, is_list)
+);
+-- the entities that have a field as a list
+CREATE TABLE list_fields (field TEXT NOT NULL, doc_id INTEGER NOT NULL);
+-- the plain (non container) values of every field, and of every list field's items
+-- value has no type on purpose, so 1 and "1" stay different values like they are in python
+CREATE TABLE field_values (field TEXT NOT NULL, in_list INTEGER NOT NULL, value, doc_id INTEGER NOT NULL);
+"""
+
+# made once everything is in, that's quicker than keeping them up to date row by row
+indexes = """
+CREATE INDEX entities_clean_name ON entities (clean_name);
+CREATE INDEX list_fields_field ON list_fields (field, doc_id);
+CREATE INDEX field_values_field ON field_values (field, in_list, value, doc_id);
+ANALYZE;
+"""
+
+# entity file path -> (mtime_ns, size, sha256) of files hashed by _is_current in this process
+_hashed_files: dict[str, tuple[int, int, str]] = {}
+
+
+class ReadOnlyError(TypeError):
+    """Raised by anything that would write to a SQLiteDB."""
+
+
+class ReadOnlyStorage(MemoryStorage):
+    # SQLiteDB's (empty) TinyDB tables, so writes that go around SQLiteDB's own methods fail too
+    def write(self, data) -> None:
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+
+def _is_plain(value) -> bool:
+    return value is None or isinstance(value, (str, int, float))
+
+
+class SQLiteDB(dt.DB):
+    storage_class = ReadOnlyStorage
+
+    def __init__(
+        self,
+        input_path: str = "./entities",
+        output_path: str = "db.sqlite",
+        workers: Optional[int] = None,
+    ):
+        """DB, but kept in the sqlite file output_path instead of in memory (and db.json).
+        The file is only rebuilt when the entity files under input_path changed, so opening an up to date one is instant.
+        It's read only: querying, fetching and rendering work like DB's, writes raise ReadOnlyError.
+        """
+        self._connection: Optional[sqlite3.Connection] = None
+        # parsed documents, the file doesn't change under a connection
+        self._documents: dict[int, Document] = {}
+        # DB's _reference_graph stays empty, this one is only built when the file is, otherwise on first use (see reference_graph)
+        self._graph: Optional[rg.ReferenceGraph] = None
+        super().__init__(input_path, output_path, in_memory=False, workers=workers)
+
+    def _create_tinydb(
+        self, input_path: str = "./entities", output_path: str = "db.sqlite"
+    ):
+        """Builds the sqlite file, unless it already holds the current contents of input_path, and opens it read only."""
+        files = {}
+        for path in dt.find_entity_files(input_path):
+            key = (
+                os.path.relpath(path, input_path) if os.path.isdir(input_path) else path
+            )
+            stat = os.stat(path)
+            files[key] = (path, stat.st_mtime_ns, stat.st_size)
+        self._graph = None
+        if not self._is_current(output_path, files):
+            self._build(output_path, files)
+        self._connection = sqlite3.connect(
+            f"file:{os.path.abspath(output_path)}?mode=ro", uri=True
+        )
+        self._documents.clear()
+        return self
+
+    def _is_current(self, output_path: str, files: dict[str, tuple]) -> bool:
+        # current if it was built from input_path by this version, from files with the same contents
+        if not os.path.exists(output_path):
+            return False
+        # read only, the published file is never written to (see _build), and the catalog's folder may not even be writable
+        uri = f"file:{os.path.abspath(output_path)}?mode=ro"
+        with closing(sqlite3.connect(uri, uri=True)) as connection:
+            try:
+                meta = dict(connection.execute("SELECT key, value FROM meta"))
+                built = {
+                    key: (mtime_ns, size, sha256)
+                    for key, mtime_ns, size, sha256 in connection.execute(
+                        "SELECT key, mtime_ns, size, sha256 FROM files"
+                    )
+                }
+            except sqlite3.DatabaseError:
+                return False
+        if (
+            meta.get("schema_version") != str(schema_version)
+            or meta.get("manifest_version") != str(dt.manifest_version)
+            or meta.get("input_path") != os.path.abspath(self.input_path)
+            or built.keys() != files.keys()
+        ):
+            return False
+        # stat first, only files whose stat moved get hashed (once per process and stat, the file keeps the old stats until a rebuild)
+        for key, (path, mtime_ns, size) in files.items():
+            if built[key][:2] == (mtime_ns, size):
+                continue
+            hashed = _hashed_files.get(os.path.abspath(path))
+            if hashed is None or hashed[:2] != (mtime_ns, size):
+                hashed = (mtime_ns, size, dt.get_file_sha256(path))
+                _hashed_files[os.path.abspath(path)] = hashed
+            if hashed[2] != built[key][2]:
+                return False
+        return True
+
+    def _build(self, output_path: str, files: dict[str, tuple]) -> None:
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(output_path)),
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            temporary_path = f.name
+        try:
+            connection = sqlite3.connect(temporary_path)
+            try:
+                self._fill(connection, files)
+            finally:
+                connection.close()
+            os.chmod(temporary_path, dt.get_replacement_mode(output_path))
+            os.replace(temporary_path, output_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def _fill(self, connection: sqlite3.Connection, files: dict[str, tuple]) -> None:
+        # it's a temporary file until it is complete, so no journal and no syncing until the end
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(schema)
+        connection.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [
+                ("schema_version", str(schema_version)),
+                ("manifest_version", str(dt.manifest_version)),
+                ("input_path", os.path.abspath(self.input_path)),
+            ],
+        )
+        owners: dict[str, str] = {}
+        graph = rg.ReferenceGraph()
+        first_seen: dict[tuple[str, bool], tuple[int, int]] = {}
+        doc_id = 0
+        loaded = dt.load_entity_files(
+            {key: path for key, (path, _, _) in files.items()}, self.workers
+        )
+        for key, (sha256, keys, docs) in loaded:
+            dt.check_duplicate_keys(owners, keys, key)
+            connection.execute(
+                "INSERT INTO files VALUES (?, ?, ?, ?)",
+                (key, files[key][1], files[key][2], sha256),
+            )
+            entities, list_fields, values = [], [], []
+            for doc in docs:
+                doc_id += 1
+                entities.append((doc_id, doc["clean_name"], key, json.dumps(doc)))
+                graph.add(doc)
+                for position, (field, value) in enumerate(doc.items()):
+                    is_list = isinstance(value, list)
+                    first_seen.setdefault((field, is_list), (doc_id, position))
+                    if is_list:
+                        list_fields.append((field, doc_id))
+                        values += [
+                            (field, True, item, doc_id)
+                            for item in value
+                            if _is_plain(item)
+                        ]
+                    elif _is_plain(value):
+                        values.append((field, False, value, doc_id))
+            connection.executemany("INSERT INTO entities VALUES (?, ?, ?, ?)", entities)
+            connection.executemany("INSERT INTO list_fields VALUES (?, ?)", list_fields)
+            connection.executemany(
+                "INSERT INTO field_values VALUES (?, ?, ?, ?)", values
+            )
+        connection.executemany(
+            "INSERT INTO fields VALUES (?, ?, ?, ?)",
+            [
+                (field, is_list, first_doc_id, position)
+                for (field, is_list), (first_doc_id, position) in first_seen.items()
+            ],
+        )
+        # names have to be unique for fetch_by_name, better to find out now than mid-render
+        duplicates = {
+            name
+            for (name,) in connection.execute(
+                "SELECT clean_name FROM entities GROUP BY clean_name HAVING count(*) > 1"
+            )
+        }
+        if duplicates:
+            raise KeyError(f"Duplicate clean_name(s): {duplicates}")
+        dt.warn_dangling(graph)
+        self._graph = graph
+        connection.executescript(indexes)
+        connection.commit()
+
+    def _get_documents(
+        self, rows: Iterable[tuple[int, str]], shared: bool = False
+    ) -> list[Document]:
+        """The documents in rows (doc_id, document). Copies like TinyDB's, unless shared, then they're this db's own parsed ones."""
+        documents = []
+        for doc_id, document in rows:
+            if doc_id not in self._documents:
+                self._documents[doc_id] = Document(json.loads(document), doc_id)
+            documents.append(self._documents[doc_id])
+        if shared:
+            return documents
+        return [Document(dict(document), document.doc_id) for document in documents]
+
+    def _prepare_worker(self) -> None:
+        # a sqlite connection mustn't be used on both sides of a fork
+        self._connection = sqlite3.connect(
+            f"file:{os.path.abspath(self.output_path)}?mode=ro", uri=True
+        )
+
+    def __reduce__(self):
+        return type(self), (self.input_path, self.output_path, 1)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            raise RuntimeError("SQLiteDB is closed.")
+        return self._connection
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        super().close()
+
+    # reading, what DB answers from TinyDB and its indexes
+
+    def __len__(self) -> int:
+        return (
+            self._get_connection()
+            .execute("SELECT count(*) FROM entities")
+            .fetchone()[0]
+        )
+
+    def __iter__(self) -> Iterator[Document]:
+        return iter(
+            self._get_documents(
+                self._get_connection().execute(
+                    "SELECT doc_id, document FROM entities ORDER BY doc_id"
+                )
+            )
+        )
+
+    def all(self) -> list[Document]:
+        return list(self)
+
+    def search(self, cond) -> list[Document]:
+        # TinyDB queries are just predicates on documents
+        return [doc for doc in self if cond(doc)]
+
+    def get(self, cond=None, doc_id=None, doc_ids=None):
+        if doc_id is not None:
+            documents = self._get_documents(
+                self._get_connection().execute(
+                    "SELECT doc_id, document FROM entities WHERE doc_id = ?", (doc_id,)
+                )
+            )
+            return documents[0] if documents else None
+        if doc_ids is not None:
+            # in table order, like TinyDB
+            return self._get_documents(
+                self._get_connection().execute(
+                    f"SELECT doc_id, document FROM entities WHERE doc_id IN ({', '.join('?' * len(doc_ids))}) ORDER BY doc_id",
+                    list(doc_ids),
+                )
+            )
+        if cond is None:
+            raise RuntimeError("You have to pass either cond or doc_id or doc_ids")
+        return next((doc for doc in self if cond(doc)), None)
+
+    def count(self, cond) -> int:
+        return len(self.search(cond))
+
+    def contains(self, cond=None, doc_id=None) -> bool:
+        if doc_id is not None:
+            return (
+                self._get_connection()
+                .execute("SELECT 1 FROM entities WHERE doc_id = ?", (doc_id,))
+                .fetchone()
+                is not None
+            )
+        if cond is None:
+            raise RuntimeError("You have to pass either cond or doc_id")
+        return self.get(cond) is not None
+
+    @property
+    def reference_graph(self) -> rg.ReferenceGraph:
+        if self._graph is None:
+            self._graph = rg.ReferenceGraph()
+            for document in self._get_documents(
+                self._get_connection().execute("SELECT doc_id, document FROM entities"),
+                shared=True,
+            ):
+                self._graph.add(document)  # type: ignore
+        return self._graph
+
+    def fetch_by_name(self, name: str):
+        """Fetches an entity by name by first converting it to clean_name.
+        As a result, passing a clean_name is fine too.
+        The returned document is shared, so don't modify it.
+        """
+        documents = self._get_documents(
+            self._get_connection().execute(
+                "SELECT doc_id, document FROM entities WHERE clean_name = ?",
+                (tx.get_clean_name(name),),
+            ),
+            shared=True,
+        )
+        if len(documents) != 1:
+            raise KeyError(f"{len(documents)} entities named {name!r}, expected 1.")
+        return documents[0]
+
+    def get_unique_array_field_values(self):
+        # fields in the order DB's index first saw them: by first entity to have them as a list, then position in it
+        fields = [
+            field
+            for (field,) in self._get_connection().execute(
+                "SELECT field FROM fields WHERE is_list ORDER BY first_doc_id, position"
+            )
+        ]
+        values = {field: set() for field in fields}
+        for field, value in self._get_connection().execute(
+            "SELECT DISTINCT field, value FROM field_values WHERE in_list"
+        ):
+            values[field].add(value)
+        return {field: list(sorted(values[field])) for field in fields}
+
+    def filter_entities(self, fields: list, params: list[list | str]):
+        """Entities where every field matches its param: equal to it for a str param, containing all of it for a list param."""
+        assert len(fields) == len(params)
+        selects, arguments = [], []
+        for field, param in zip(fields, params):
+            if isinstance(param, str):
+                selects.append(
+                    "SELECT doc_id FROM field_values WHERE field = ? AND NOT in_list AND value = ?"
+                )
+                arguments += [field, param]
+                continue
+            if (
+                self._get_connection()
+                .execute(
+                    "SELECT 1 FROM fields WHERE field = ? AND NOT is_list",
+                    (field,),
+                )
+                .fetchone()
+            ):
+                # TinyDB's .all() on a string is a substring test, that takes the documents themselves
+                return self._filter_entities_query(fields, params)
+            if not param:  # otherwise having the items already means having the list
+                selects.append("SELECT doc_id FROM list_fields WHERE field = ?")
+                arguments.append(field)
+            for value in param:
+                selects.append(
+                    "SELECT doc_id FROM field_values WHERE field = ? AND in_list AND value = ?"
+                )
+                arguments += [field, value]
+        return self._get_documents(
+            self._get_connection().execute(
+                f"""SELECT doc_id, document FROM entities
+                WHERE doc_id IN ({' INTERSECT '.join(selects)}) ORDER BY doc_id""",
+                arguments,
+            )
+        )
+
+    # it's a read only catalog
+
+    def insert(self, document):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def insert_multiple(self, documents):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def update(self, fields, cond=None, doc_ids=None):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def update_multiple(self, updates):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def upsert(self, document, cond=None):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def remove(self, cond=None, doc_ids=None):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def truncate(self):
+        raise ReadOnlyError("SQLiteDB is read only, edit the entity files.")
+
+    def save(self, output_path: Optional[str] = None):
+        raise ReadOnlyError("SQLiteDB is read only, it's saved as it's built.")
@@ -1,6 +1,28 @@
+import importlib
+import io
+import itertools
+import json
+import os
+import sys
+import math
+from collections import Counter
+
+import numpy as np
 import pytest
+from tinydb import Query
 from ttrpyg.database import DB
+from ttrpyg.sqlite_database import SQLiteDB, ReadOnlyError
 import ttrpyg.text as tx
+import ttrpyg.my_types as ty
+import ttrpyg.dice_utils as du
+import ttrpyg.simulation as sim
+import ttrpyg.disk_cache as dc
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # so no test reads results cached by an older version of the code
+    monkeypatch.setenv("TTRPYG_CACHE_DIR", str(tmp_path / "cache"))
 
 
 @pytest.fixture
@@ -18,6 +40,24 @@ def test_db(tmp_path):
     db.close()  # Close the database when the tests are
 
 
+def write_entities(tmp_path, entities: dict, file: str = "a.json") -> str:
+    """Writes entities to tmp_path/entities/file, returning the entities folder."""
+    (tmp_path / "entities").mkdir(exist_ok=True)
+    (tmp_path / "entities" / file).write_text(json.dumps(entities))
+    return str(tmp_path / "entities")
+
+
+def make_catalog(
+    tmp_path, entities: dict, db_class=DB, file: str = "a.json", **db_kwargs
+):
+    """A db_class built from entities, written with write_entities. Its output goes in tmp_path too."""
+    db_kwargs.setdefault(
+        "output_path",
+        str(tmp_path / ("db.sqlite" if db_class is SQLiteDB else "db.json")),
+    )
+    return db_class(write_entities(tmp_path, entities, file), **db_kwargs)
+
+
 # not sure we need an outside of funcs db
 db = DB()  # dt.create_tinydb()
 
@@ -63,3 +103,730 @@ def test_fetch_by_name(test_db):
     # remake asserts later
     db.single_curly_parser("{Man From Saint Ives}", False, False).strip()
     db.single_curly_parser("{Man From Saint Ives}", True, False)
+
+
+def test_sum_distribution():
+    dice = [4, 6, 6, 10]
+    counts = {}
+    for rolled in itertools.product(*[range(1, die + 1) for die in dice]):
+        counts[sum(rolled)] = counts.get(sum(rolled), 0) + 1
+    assert du.all_rolls(dice, "counts") == counts
+    assert list(du.all_rolls(dice, "counts")) == sorted(counts)
+    assert du.sum_distribution(dice, "counts", modifier=-3) == {
+        k - 3: v for k, v in counts.items()
+    }
+    big = du.sum_distribution([6] * 50, "counts")
+    assert sum(big.values()) == 6**50
+    assert min(big) == 50 and max(big) == 300
+    approx = du.sum_distribution([6] * 50, "probabilities", method="normal")
+    assert abs(sum(approx.values()) - 1) < 1e-9
+    assert abs(approx[175] - big[175] / 6**50) < 1e-4
+
+
+def test_weighted_multisets():
+    for dice in ([6, 6], [4] * 3, [6] * 5):
+        expected = Counter(
+            tuple(sorted(r))
+            for r in itertools.product(*[range(1, d + 1) for d in dice])
+        )
+        assert dict(du.weighted_multisets(dice)) == expected
+
+
+def test_die_parser_roller_batch():
+    assert du.die_parser_roller_batch("3d1+2", 5).tolist() == [5] * 5
+    assert du.die_parser_roller_batch("1d1x", 5).tolist() == [1] * 5
+    assert du.die_parser_roller_batch("1d4-10", 5).tolist() == [0] * 5
+    rolls = du.die_parser_roller_batch("2d6x", 10000)
+    assert rolls.shape == (10000,) and rolls.min() >= 2
+    assert (rolls > 12).any()
+
+
+def test_compile_dice():
+    dice = du.compile_dice("{2d6x+1}")
+    assert dice == du.DiceExpression(quantity=2, faces=6, explode=True, modifier=1)
+    assert dice is du.compile_dice("{2d6x+1}")
+    assert (dice.min, dice.max, dice.mean) == (3, math.inf, 9.4)
+    assert du.compile_dice("d4-6").mean == 0.0
+    assert du.compile_dice("2d4-6").mean == 0.25
+    with pytest.raises(ValueError):
+        du.compile_dice("no dice here")
+
+
+def test_rng_replay():
+    def run(rng=None):
+        return (
+            [du.die_parser_roller("3d6x", rng) for _ in range(20)],
+            du.die_parser_roller_batch("2d8+1", 20, rng).tolist(),
+            [c["quantity"] for c in tx.parse_curlies("{1d20 a} {2d6x b}", rng)],
+        )
+
+    assert run(du.RNG(7)) == run(du.RNG(7))
+    with du.use_rng(7):
+        assert run() == run(du.RNG(7)) != run()
+    first, second = du.RNG(7).spawn(2)
+    assert run(first) != run(second)
+    assert run(du.RNG(7).spawn(2)[1]) == run(du.RNG(7).spawn(2)[1])
+
+
+def test_simulate(monkeypatch):
+    # a run that fits in one shard never starts a pool, whatever workers says
+    monkeypatch.setattr(sim, "ProcessPoolExecutor", None)
+    assert sim.simulate("2d1+1", 500, workers=8)["histogram"] == {3: 500}
+    monkeypatch.undo()
+    result = sim.simulate("2d1+1", 25_000, workers=1, shard_size=10_000)
+    assert result["histogram"] == {3: 25_000}
+    assert result["mean"] == 3 and result["variance"] == 0
+    seeded = sim.simulate("3d6x", 30_000, seed=3, workers=1, shard_size=10_000)
+    assert seeded == sim.simulate("3d6x", 30_000, seed=3, workers=1, shard_size=10_000)
+    stopped = sim.simulate("3d6x", 10**7, precision=0.1, seed=3, workers=1)
+    assert stopped["converged"] and stopped["trials"] < 10**7
+
+
+def test_pass_probability():
+    assert du.check_counts(0) == du.all_rolls([6, 6], "counts")
+    assert du.get_pass_probability(0, 7) == 21 / 36
+    assert du.get_pass_probability(0, 2) == 1.0
+    assert du.get_pass_probability(0, 13) == 0.0
+    grid = du.pass_probability(np.arange(0, 3)[:, None], np.arange(2, 16)[None, :])
+    assert grid.shape == (3, 14)
+    assert grid[1, 6] == du.get_pass_probability(1, 8)
+    assert du.get_pass_probability(0, 12, 1) > du.get_pass_probability(0, 12)
+    dcs = du.required_dc([0, 0, 3], [21 / 36, 0.5, 1.0], [0, 0, -2])
+    assert dcs.tolist() == [7, 7, 5]
+
+
+def test_dice_stats():
+    stats = du.dice_stats("3d6")
+    assert stats["pmf"] == pytest.approx(du.all_rolls([6] * 3, "probabilities"))
+    assert stats["mean"] == pytest.approx(10.5) and stats["skew"] == pytest.approx(0)
+    assert stats["variance"] == pytest.approx(3 * 35 / 12)
+    assert du.dice_stats("2d4-6")["pmf"] == {0: 13 / 16, 1: 2 / 16, 2: 1 / 16}
+    exploding = du.dice_stats("1d6x", tolerance=1e-9)
+    assert (
+        exploding["mean"] == pytest.approx(4.2) and exploding["truncated_mass"] < 1e-9
+    )
+    assert 6 not in exploding["pmf"]
+    assert du.dice_quantile("3d6", [0, 0.5, 1]).tolist() == [3, 10, 18]
+
+
+def test_disk_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("TTRPYG_CACHE_DIR", str(tmp_path))
+    calls = []
+
+    @dc.disk_cache
+    def table(adv_range: int = 3):
+        calls.append(adv_range)
+        return {"adv_range": adv_range}
+
+    assert table(2) == table(adv_range=2) == {"adv_range": 2}
+    assert calls == [2] and len(os.listdir(tmp_path)) == 1
+    table(4)
+    dc.evict(0)
+    assert os.listdir(tmp_path) == []
+    assert table(2) == {"adv_range": 2} and calls == [2, 4, 2]
+
+    # editing the function's module makes a new entry
+    (tmp_path / "cached.py").write_text(
+        "import ttrpyg.disk_cache as dc\n\n@dc.disk_cache\ndef f():\n    return 1\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, "dont_write_bytecode", True)
+    import cached
+
+    assert cached.f() == 1
+    (tmp_path / "cached.py").write_text(
+        "import ttrpyg.disk_cache as dc\n\n@dc.disk_cache\ndef f():\n    return 22\n"
+    )
+    dc._source_hash.cache_clear()
+    importlib.reload(cached)
+    assert cached.f() == 22
+    del sys.modules["cached"]
+
+
+def test_table_intervals():
+    table = du.compile_table({"outcomes": {"1-1000": "common", "1001": "rare"}})
+    assert table["roll"] == "1d1001"
+    assert table["intervals"] == {
+        "starts": [1, 1001],
+        "ends": [1000, 1001],
+        "outcomes": ["common", "rare"],
+    }
+    entity = ty.Entity({"name": "Loot", "table": table})
+    curly = tx.parse_curlies("{loot 2d1000x+5000}")[0]
+    assert du.roll_on_table(entity, curly) == "rare"
+    assert du.roll_on_table(entity, curly, bound_roll=True) == "rare"
+    # a compiled curly's table dice are rolled when it's used
+    assert du.roll_on_table(entity, tx.compile_curlies("{loot 2d6+1000}")[0]) == "rare"
+    assert set(du.roll_on_table_many(entity, 20000)) == {"common", "rare"}
+    assert du.roll_on_table_many(entity, 3, curly) == ["rare"] * 3
+    with pytest.raises(KeyError):
+        du.roll_on_table_many(entity, 3, curly, bound_roll=False)
+    with pytest.raises(ValueError):
+        du.compile_table({"outcomes": {"1-3": "a", "3": "b"}})
+
+
+def test_alias_sampler(tmp_path):
+    table = du.compile_table(
+        {"roll": "2d6", "outcomes": {"2-6": "low", "7": "seven", "8-12": "high"}}
+    )
+    assert table["sampler"]["probabilities"] == pytest.approx(
+        [15 / 36, 6 / 36, 15 / 36]
+    )
+    clamped = du.compile_table({"roll": "1d6x", "outcomes": {"1-3": "a", "4-5": "b"}})
+    assert clamped["sampler"]["probabilities"] == pytest.approx([1 / 2, 1 / 2])
+    gappy = du.compile_table({"roll": "1d4", "outcomes": {"1": "a", "3-4": "b"}})
+    assert "sampler" not in gappy
+    rows = du.alias_sample_many(table["sampler"], 360_000, du.RNG(1))
+    assert np.bincount(rows) / 360_000 == pytest.approx(
+        [15 / 36, 6 / 36, 15 / 36], abs=0.005
+    )
+    # a roll that isn't dice doesn't stop the catalog building, only rolling on that table fails
+    odd_db = make_catalog(
+        tmp_path,
+        {
+            "fate": {
+                "name": "Fate",
+                "table": {"roll": "special", "outcomes": {"1": "a"}},
+            },
+            "blank": {
+                "name": "Blank",
+                "table": {"roll": None, "outcomes": {"1-2": "b"}},
+            },
+        },
+        in_memory=True,
+    )
+    fate, blank = odd_db.fetch_by_name("fate"), odd_db.fetch_by_name("blank")
+    assert "sampler" not in fate["table"] and "sampler" not in blank["table"]
+    with pytest.raises(ValueError, match="special"):
+        du.roll_on_table(fate, tx.parse_curlies("{fate}")[0])
+    assert du.roll_on_table(blank, tx.parse_curlies("{blank}")[0]) == "b"
+    assert du.roll_on_table_many(blank, 5) == ["b"] * 5
+    rng = du.RNG(2)
+    assert Counter(du.alias_sample(table["sampler"], rng) for i in range(36_000))[
+        1
+    ] == pytest.approx(6_000, abs=300)
+
+
+def test_name_index(tmp_path):
+    name_db = make_catalog(
+        tmp_path, {"goblin": {"name": "Goblin"}, "orc": {"name": "Orc"}}
+    )
+    assert name_db.fetch_by_name("Goblin")["clean_name"] == "goblin"
+    doc_id = name_db.insert({"name": "Troll", "clean_name": "troll"})
+    assert name_db.fetch_by_name("troll").doc_id == doc_id
+    name_db.update({"clean_name": "cave_troll"}, doc_ids=[doc_id])
+    assert name_db.fetch_by_name("Cave Troll").doc_id == doc_id
+    with pytest.raises(KeyError):
+        name_db.fetch_by_name("troll")
+    name_db.remove(doc_ids=[doc_id])
+    with pytest.raises(KeyError):
+        name_db.fetch_by_name("cave_troll")
+    # tinydb's other write paths keep the indexes up to date too
+    (doc_id,) = name_db.upsert(
+        {"name": "Troll", "clean_name": "troll", "tags": ["big"]},
+        Query().clean_name == "troll",
+    )
+    assert name_db.fetch_by_name("troll").doc_id == doc_id
+    name_db.upsert({"tags": ["huge"]}, Query().clean_name == "troll")
+    assert name_db.filter_entities(["tags"], [["huge"]])[0].doc_id == doc_id
+    name_db.update_multiple([({"tags": ["green"]}, Query().clean_name == "troll")])
+    assert name_db.filter_entities(["tags"], [["huge"]]) == []
+    assert name_db.filter_entities(["tags"], [["green"]])[0]["tags"] == ["green"]
+    name_db.close()
+    with pytest.raises(KeyError, match="goblin"):
+        make_catalog(tmp_path, {"other_goblin": {"name": "goblin"}}, file="b.json")
+
+
+def test_filter_entities():
+    for fields, params in [
+        (["tags"], [["animal"]]),
+        (["tags", "meta_tags"], [("animal", "small"), ["basic"]]),
+        (["tags"], [[]]),
+        (["name"], ["Gold"]),
+        (["tags", "name"], [["currency"], "Gem"]),
+        (["effect"], [["kits"]]),
+        (["hp"], ["3"]),
+    ]:
+        assert db.filter_entities(fields, params) == db._filter_entities_query(
+            fields, params
+        )
+    unique = db.get_unique_array_field_values()
+    assert "animal" in unique["tags"] and unique["tags"] == sorted(unique["tags"])
+    # results are copies, changing one leaves the db alone
+    db.filter_entities(["name"], ["Gold"])[0]["name"] = "Lead"
+    assert db.filter_entities(["name"], ["Gold"])[0]["name"] == "Gold"
+
+
+def test_db_output(tmp_path):
+    gem = {"gem": {"name": "Gem", "table": {"outcomes": {"1-2": "Ruby"}}}}
+    make_catalog(
+        tmp_path, gem, output_path=str(tmp_path / "memory.json"), in_memory=True
+    )
+    assert not (tmp_path / "memory.json").exists()
+    make_catalog(tmp_path, gem).close()
+    written = json.loads((tmp_path / "db.json").read_text())["_default"]["1"]
+    assert written["table"]["intervals"]["outcomes"] == ["Ruby"]
+    # no temporary files left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "db.json",
+        "db.json.manifest",
+        "db.json.snapshot",
+        "entities",
+    ]
+    # a rewrite keeps the mode the file had
+    os.chmod(tmp_path / "db.json", 0o640)
+    make_catalog(tmp_path, {"orc": {"name": "Orc"}}).close()
+    assert os.stat(tmp_path / "db.json").st_mode & 0o777 == 0o640
+
+
+def test_incremental_build(tmp_path, monkeypatch):
+    entities = tmp_path / "entities"
+    write_entities(tmp_path, {"goblin": {"name": "Goblin"}})
+    write_entities(
+        tmp_path,
+        {"gem": {"name": "Gem", "table": {"outcomes": {"1-2": "Ruby"}}}},
+        "b.json",
+    )
+    paths = (str(entities), str(tmp_path / "db.json"))
+    DB(*paths).close()
+
+    # unchanged files are never parsed or compiled again
+    compiled = []
+    monkeypatch.setattr(du, "compile_table", lambda table: compiled.append(table))
+    warm_db = DB(*paths)
+    assert warm_db.fetch_by_name("gem")["table"]["intervals"]["outcomes"] == ["Ruby"]
+    assert compiled == []
+    monkeypatch.undo()
+
+    write_entities(tmp_path, {"orc": {"name": "Orc"}})
+    write_entities(tmp_path, {"troll": {"name": "Troll"}}, "c.json")
+    os.remove(entities / "b.json")
+    changed_db = DB(*paths)
+    assert sorted(doc["clean_name"] for doc in changed_db) == ["orc", "troll"]
+    with pytest.raises(KeyError):
+        changed_db.fetch_by_name("goblin")
+    assert DB(*paths).filter_entities(["name"], ["Orc"]) == [
+        {"name": "Orc", "clean_name": "orc"}
+    ]
+
+    write_entities(tmp_path, {"orc": {"name": "Other Orc"}}, "d.json")
+    with pytest.raises(KeyError, match=r"Duplicate Key.*d\.json.*a\.json"):
+        DB(*paths)
+    # a db.json that doesn't match its manifest gets rebuilt from scratch
+    os.remove(entities / "d.json")
+    (tmp_path / "db.json").write_text(json.dumps({"_default": {}}))
+    assert len(DB(*paths)) == 2
+
+    # a touched file's keys still count when a changed file is checked
+    write_entities(tmp_path, {"goblin": {"name": "Goblin"}})
+    write_entities(tmp_path, {"orc": {"name": "Orc"}}, "c.json")
+    DB(*paths).close()
+    write_entities(
+        tmp_path, {"goblin": {"name": "Goblin"}, "orc": {"name": "Orc Chief"}}
+    )
+    stat = os.stat(entities / "c.json")
+    os.utime(entities / "c.json", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(KeyError, match="Duplicate Key"):
+        DB(*paths)
+
+
+def test_snapshot(tmp_path, monkeypatch):
+    paths = (
+        write_entities(
+            tmp_path,
+            {
+                "goblin": {"name": "Goblin", "tags": ["small"]},
+                "gem": {"name": "Gem", "table": {"outcomes": {"1-2": "Ruby"}}},
+            },
+        ),
+        str(tmp_path / "db.json"),
+    )
+    cold_db = DB(*paths)
+
+    # a warm start is the snapshot alone, no entity files or db.json parsed and nothing reindexed
+    monkeypatch.setattr("ttrpyg.database.load_entity_file", None)
+    monkeypatch.setattr(DB, "_load_previous_build", None)
+    monkeypatch.setattr(DB, "_reindex", None)
+    warm_db = DB(*paths)
+    monkeypatch.undo()
+    assert list(warm_db) == list(cold_db)
+    assert warm_db.filter_entities(["tags"], [["small"]]) == [
+        {"name": "Goblin", "tags": ["small"], "clean_name": "goblin"}
+    ]
+    assert (
+        warm_db.fetch_by_name("gem")["table"] == cold_db.fetch_by_name("gem")["table"]
+    )
+    # the indexes still follow writes after a restore
+    warm_db.update({"tags": ["big"]}, doc_ids=[warm_db.fetch_by_name("goblin").doc_id])
+    assert warm_db.filter_entities(["tags"], [["small"]]) == []
+
+    # a snapshot that doesn't go with the manifest is ignored
+    (tmp_path / "db.json.snapshot").write_bytes(b"not a snapshot")
+    assert list(DB(*paths)) == list(cold_db)
+    write_entities(tmp_path, {"orc": {"name": "Orc"}})
+    assert [doc["clean_name"] for doc in DB(*paths)] == ["orc"]
+
+
+def test_parallel_load(tmp_path, monkeypatch):
+    (tmp_path / "entities" / "nested").mkdir(parents=True)
+    for i in range(6):
+        entities = write_entities(
+            tmp_path,
+            {
+                f"group_{i}": {
+                    f"thing_{i}": {
+                        "name": f"Thing {i}",
+                        "table": {"outcomes": {"1-3": f"{i}"}},
+                    }
+                }
+            },
+            f"nested/{i}.json" if i % 2 else f"{i}.json",
+        )
+    serial_db = DB(entities, in_memory=True, workers=1)
+    parallel_db = DB(entities, in_memory=True, workers=3)
+    assert list(parallel_db) == list(serial_db)
+    assert parallel_db.fetch_by_name("Thing 5")["table"]["intervals"]["ends"] == [3]
+    # by default a pool is forked once there are enough files, and never spawned
+    monkeypatch.setattr("ttrpyg.database.pool_min_files", 2)
+    monkeypatch.setattr(os, "cpu_count", lambda: 2)
+    assert list(DB(entities, in_memory=True)) == list(serial_db)
+    monkeypatch.setattr("multiprocessing.get_all_start_methods", lambda: ["spawn"])
+    monkeypatch.setattr("ttrpyg.database.ProcessPoolExecutor", None)
+    assert list(DB(entities, in_memory=True)) == list(serial_db)
+
+
+def test_sqlite_db(tmp_path, monkeypatch):
+    sqlite_db = SQLiteDB(output_path=str(tmp_path / "db.sqlite"))
+    assert list(sqlite_db) == list(db)
+    assert (
+        sqlite_db.get_unique_array_field_values() == db.get_unique_array_field_values()
+    )
+    for doc in db:
+        assert sqlite_db.fetch_by_name(doc["name"]) == doc
+    for fields, params in [
+        (["tags"], [["animal"]]),
+        (["tags", "meta_tags"], [("animal", "small"), ["basic"]]),
+        (["tags"], [[]]),
+        (["name"], ["Gold"]),
+        (["tags", "name"], [["currency"], "Gem"]),
+        (["effect"], [["kits"]]),
+        (["hp"], ["3"]),
+    ]:
+        assert sqlite_db.filter_entities(fields, params) == db.filter_entities(
+            fields, params
+        )
+    query = Query().tags.any(["animal", "currency"])
+    assert sqlite_db.create_query_text_section(query) == db.create_query_text_section(
+        query
+    )
+    assert sqlite_db.single_curly_parser(
+        "{Man From Saint Ives}", True, True, du.RNG(3)
+    ) == db.single_curly_parser("{Man From Saint Ives}", True, True, du.RNG(3))
+    gold = Query().name == "Gold"
+    assert sqlite_db.get(gold) == db.get(gold)
+    assert sqlite_db.get(doc_id=2) == db.get(doc_id=2)
+    assert sqlite_db.get(doc_ids=[3, 1]) == db.get(doc_ids=[3, 1])
+    assert sqlite_db.count(Query().tags.any(["animal"])) == db.count(
+        Query().tags.any(["animal"])
+    )
+    assert sqlite_db.contains(gold) and sqlite_db.contains(doc_id=1)
+    assert not sqlite_db.contains(doc_id=10**6)
+    # reads hand out copies
+    sqlite_db.get(gold)["name"] = "Lead"
+    assert sqlite_db.get(gold) is not None
+    # and every way of writing fails, including tinydb's own
+    for write in [
+        lambda: sqlite_db.insert({"name": "Troll"}),
+        lambda: sqlite_db.upsert({"name": "Troll"}, gold),
+        lambda: sqlite_db.update_multiple([({"name": "Lead"}, gold)]),
+        lambda: sqlite_db.table("other").insert({"name": "Troll"}),
+        lambda: sqlite_db.drop_tables(),
+    ]:
+        with pytest.raises(ReadOnlyError):
+            write()
+
+    paths = (
+        write_entities(tmp_path, {"goblin": {"name": "Goblin"}}),
+        str(tmp_path / "small.sqlite"),
+    )
+    reader = SQLiteDB(*paths)
+    write_entities(tmp_path, {"orc": {"name": "Orc"}})
+    rebuilt = SQLiteDB(*paths)
+    assert [doc["clean_name"] for doc in rebuilt] == ["orc"]
+    # the rebuild replaced the file, readers that had the old one open still see it whole
+    assert [doc["clean_name"] for doc in reader] == ["goblin"]
+    with pytest.raises(KeyError):
+        rebuilt.fetch_by_name("goblin")
+    # a touched file is hashed (once), but the published file isn't rebuilt or written to
+    published = os.stat(paths[1])
+    stat = os.stat(tmp_path / "entities" / "a.json")
+    os.utime(
+        tmp_path / "entities" / "a.json",
+        ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9),
+    )
+    monkeypatch.setattr(SQLiteDB, "_build", None)
+    assert [doc["clean_name"] for doc in SQLiteDB(*paths)] == ["orc"]
+    monkeypatch.setattr("ttrpyg.database.get_file_sha256", None)
+    assert [doc["clean_name"] for doc in SQLiteDB(*paths)] == ["orc"]
+    assert os.stat(paths[1]).st_mtime_ns == published.st_mtime_ns
+
+
+def test_render_cache(tmp_path, monkeypatch):
+    render_db = make_catalog(
+        tmp_path,
+        {
+            "horde": {"name": "Horde", "effect": "{50 goblin}"},
+            "goblin": {"name": "Goblin", "effect": "Carries {2 coin} {1d4 rock}"},
+            "coin": {"name": "Coin"},
+            "rock": {"name": "Rock"},
+        },
+        in_memory=True,
+    )
+    rendered = []
+    generate_entity_text = tx.generate_entity_text
+    monkeypatch.setattr(
+        tx,
+        "generate_entity_text",
+        lambda entity, *args: rendered.append(entity["clean_name"])
+        or generate_entity_text(entity, *args),
+    )
+    render_db.single_curly_parser("{horde}", True, True, du.RNG(1))
+    # every entity was rendered once per way of rendering it, however often it showed up
+    assert Counter(rendered) == {"horde": 2, "goblin": 1, "coin": 1, "rock": 1}
+
+    render_db.update({"effect": "Carries nothing"}, doc_ids=[2])
+    assert "nothing" in render_db.render_entity_text("Goblin")
+    # the static part of parsing is shared, the rolls aren't
+    compiled = tx.compile_curlies("{1d6 goblin 1d4} {2 coin 3}")
+    assert tx.compile_curlies("{1d6 goblin 1d4} {2 coin 3}") is compiled
+    assert tx.roll_curlies(compiled, du.RNG(5)) == tx.parse_curlies(
+        "{1d6 goblin 1d4} {2 coin 3}", du.RNG(5)
+    )
+
+
+def test_expand_entity_tree(tmp_path):
+    tree_db = make_catalog(
+        tmp_path,
+        {
+            "wife": {"name": "Wife", "holds": "{7 sack}"},
+            "sack": {"name": "Sack", "holds": "{7 cat}"},
+            "cat": {"name": "Cat", "holds": "{1d1+6 kit}"},
+            "kit": {"name": "Kit"},
+            "ouroboros": {"name": "Ouroboros", "effect": "Eats {1 ouroboros}."},
+        },
+        in_memory=True,
+    )
+    wife = tx.parse_curlies("{1 wife}")[0]
+    expansion = tree_db.expand_entity_tree(
+        wife, True, True, rng=du.RNG(1), max_nodes=None
+    )
+    tree = expansion["tree"]
+    # a wife, 7 sacks, 49 cats, 343 kits
+    assert len(tree) == 400 and not expansion["truncated"]
+    for node in tree:
+        for child in node["children"]:
+            assert tree[child]["parent"] == node["id"]
+            assert tree[child]["depth"] == node["depth"] + 1
+    assert [node["entity"] for node in tree[:2]] == ["wife", "sack"]
+
+    for budgets, reason, size in [
+        ({"max_nodes": 100}, "max_nodes", 100),
+        ({"max_nodes": None, "max_depth": 2}, "max_depth", 57),
+    ]:
+        expansion = tree_db.expand_entity_tree(
+            wife, True, True, rng=du.RNG(1), **budgets
+        )
+        assert expansion["truncated"] and expansion["reason"] == reason
+        assert len(expansion["tree"]) == size
+    assert "### Truncated:" in tree_db.single_curly_parser(
+        "{1 wife}", True, True, du.RNG(1), max_nodes=10
+    )
+
+    ouroboros = tx.parse_curlies("{ouroboros}")[0]
+    expansion = tree_db.expand_entity_tree(ouroboros, True, True, rng=du.RNG(1))
+    assert len(expansion["tree"]) == 1 and not expansion["truncated"]
+    assert expansion["cycles"] == [["ouroboros", "ouroboros"]]
+
+
+def test_stream_entity_tree(tmp_path):
+    stream_db = make_catalog(
+        tmp_path,
+        {
+            "hoard": {"name": "Hoard", "holds": "{1000 goblin}"},
+            "goblin": {"name": "Goblin", "holds": "{1d4 coin}"},
+            "coin": {"name": "Coin"},
+        },
+        in_memory=True,
+    )
+    hoard = tx.parse_curlies("{hoard}")[0]
+    nodes = stream_db.iter_entity_tree(hoard, True, True, rng=du.RNG(1), max_nodes=None)
+    # nodes come out while the expansion is still going
+    assert [next(nodes)["entity"] for i in range(3)] == ["hoard", "goblin", "goblin"]
+    nodes.close()
+
+    chunks = stream_db.iter_entity_tree_text(
+        hoard, True, True, rng=du.RNG(1), max_nodes=50
+    )
+    assert next(chunks) == "### Unique Entities, Full Tree:\n"
+    streamed = io.StringIO()
+    stream_db.write_entity_tree_text(
+        streamed, hoard, True, True, rng=du.RNG(1), max_nodes=50
+    )
+    text = stream_db.generate_entity_tree_text(
+        hoard, True, True, rng=du.RNG(1), max_nodes=50
+    )
+    # same layout, non unique entities and all
+    assert "### Non Unique Entities:" in text
+    assert streamed.getvalue().strip() == text
+    assert streamed.getvalue().rstrip().endswith("this tree is incomplete.")
+
+
+def test_generate_many(tmp_path):
+    batch_db = make_catalog(
+        tmp_path,
+        {
+            "chest": {"name": "Chest", "holds": "{2d6 coin} and {gem 1d4}"},
+            "coin": {"name": "Coin"},
+            "gem": {
+                "name": "Gem",
+                "table": {"outcomes": {"1-2": "Ruby", "3": "Opal", "4": "Jet"}},
+            },
+        },
+        in_memory=True,
+    )
+    serial = batch_db.generate_many("{chest}", 40, seed=3, workers=1)
+    assert batch_db.generate_many("{chest}", 40, seed=3, workers=3) == serial
+    assert len(set(serial)) > 1
+    # mixed batches too
+    assert (
+        batch_db.generate_many(["{gem}", "{chest}"], seed=3, workers=2)[1]
+        == batch_db.generate_many(["{gem}", "{chest}"], seed=3, workers=1)[1]
+    )
+    with pytest.raises(ValueError):
+        batch_db.generate_many(["{chest}"], 2)
+
+
+def test_reference_graph(tmp_path):
+    paths = (
+        write_entities(
+            tmp_path,
+            {
+                "chest": {
+                    "name": "Chest",
+                    "holds": "{2d6 coin} and {loot 1d2}",
+                    "table": {"roll": "1d4", "outcomes": {"1-3": "{gem}", "4": "-"}},
+                },
+                "loot": {
+                    "name": "Loot",
+                    "table": {
+                        "outcomes": {"1": "{1d4 coin}", "2": "{gem}", "3": "{10 coin}"}
+                    },
+                },
+                "coin": {"name": "Coin"},
+                "gem": {"name": "Gem"},
+                "snake": {"name": "Snake", "effect": "Bites a {rat}."},
+                "rat": {"name": "Rat", "effect": "Bites a {snake}."},
+                "haunt": {"name": "Haunt", "effect": "{1 ghost}"},
+            },
+        ),
+        str(tmp_path / "db.json"),
+    )
+    with pytest.warns(UserWarning, match="ghost"):
+        graph_db = DB(*paths)
+    graph = graph_db.reference_graph
+    assert graph.referenced_by("coin") == ["chest", "loot"]
+    assert graph.reachable("chest") == {"coin", "gem", "loot"}
+    assert graph.cycles() == [["rat", "snake", "rat"]]
+    assert graph.dangling() == {"ghost": ["haunt"]}
+    with pytest.raises(KeyError):
+        graph.max_expansion("haunt")
+    chest_references = [(r["target"], r["row"]) for r in graph.references["chest"]]
+    assert chest_references == [("coin", None), ("loot", None), ("gem", 0)]
+    # 12 coins, loot's row 1 or 2 (1d2 bounds it away from the 10 coins) and a gem
+    assert graph.max_expansion("chest") == 1 + 12 + 5 + 1
+    assert graph.max_expansion("snake") == math.inf
+    chest = tx.parse_curlies("{chest}")[0]
+    for seed in range(50):
+        expansion = graph_db.expand_entity_tree(
+            chest, True, True, rng=du.RNG(seed), max_nodes=None
+        )
+        assert expansion["nodes"] <= graph.max_expansion("chest")
+
+    # it comes back with the snapshot, and writes keep it up to date
+    with pytest.warns(UserWarning, match="ghost"):
+        reloaded = DB(*paths)
+    assert reloaded.reference_graph.references == graph.references
+    graph_db.insert({"name": "Ghost", "clean_name": "ghost"})
+    assert graph.dangling() == {}
+    graph_db.remove(Query().clean_name == "chest")
+    assert graph.referenced_by("loot") == [] and "chest" not in graph
+    with pytest.warns(UserWarning, match="ghost"):
+        sqlite_db = SQLiteDB(paths[0], str(tmp_path / "db.sqlite"))
+    assert sqlite_db.reference_graph.cycles() == [["rat", "snake", "rat"]]
+    assert sqlite_db.reference_graph.max_expansion("chest") == 19
+    # a table rolled on something that isn't dice could land on any row
+    fate = {"roll": "special", "outcomes": {"1": "{gem}", "2": "{10 coin}"}}
+    graph.add(
+        ty.Entity(
+            {"name": "Fate", "clean_name": "fate", "table": du.compile_table(fate)}
+        )
+    )
+    assert graph.get_rows("fate") == range(2)
+    assert graph.max_expansion("fate") == 1 + 10
+
+
+def test_entity_count_distributions(tmp_path):
+    count_db = make_catalog(
+        tmp_path,
+        {
+            "chest": {
+                "name": "Chest",
+                "holds": "{1d2 coin}",
+                "table": {
+                    "roll": "1d4",
+                    "outcomes": {"1-3": "{gem}", "4": "{2 coin}"},
+                },
+            },
+            "coin": {"name": "Coin"},
+            "gem": {"name": "Gem"},
+            "snake": {"name": "Snake", "effect": "Bites a {rat}."},
+            "rat": {"name": "Rat", "effect": "Bites a {snake}, drops a {coin}."},
+            "gappy": {
+                "name": "Gappy",
+                "table": {"roll": "1d6", "outcomes": {"1": "-", "3-6": "-"}},
+            },
+        },
+        in_memory=True,
+    )
+    assert count_db.get_entity_count_distributions("{chest}") == {
+        "coin": pytest.approx({1: 3 / 8, 2: 3 / 8, 3: 1 / 8, 4: 1 / 8}),
+        "gem": pytest.approx({0: 1 / 4, 1: 3 / 4}),
+    }
+    # table dice are rolled once for both chests, without them each chest rolls its own
+    gems = count_db.get_entity_count_distributions("{2 chest 1d4}", ["gem"])
+    assert gems["gem"] == pytest.approx({0: 1 / 4, 2: 3 / 4})
+    gems = count_db.get_entity_count_distributions("{2 chest}", ["gem"])
+    assert gems["gem"] == pytest.approx({0: 1 / 16, 1: 6 / 16, 2: 9 / 16})
+    # the expander doesn't follow the rat back into the snake
+    assert count_db.get_entity_count_distributions("{snake}") == {"coin": {1: 1.0}}
+    coins = count_db.get_entity_count_distributions("{1d6x chest}", ["coin"])["coin"]
+    assert math.isclose(sum(coins.values()), 1)
+    assert math.isclose(
+        sum(count * p for count, p in coins.items()), 3.5 * 6 / 5 * (1.5 + 0.5)
+    )
+
+    rng = du.RNG(5)
+    samples = Counter()
+    for i in range(2000):
+        expansion = count_db.expand_entity_tree(
+            tx.parse_curlies("{1d4 chest}", rng)[0], True, True, rng=rng, max_nodes=None
+        )
+        samples[sum(node["entity"] == "coin" for node in expansion["tree"])] += 1
+    coins = count_db.get_entity_count_distributions("{1d4 chest}", ["coin"])["coin"]
+    for count, p in coins.items():
+        assert abs(samples[count] / 2000 - p) < 0.03
+
+    with pytest.raises(ValueError):
+        count_db.get_entity_count_distributions("{gappy}")
+    with pytest.raises(KeyError):
+        count_db.get_entity_count_distributions("{ghost}")
@@ -2,6 +2,8 @@ import os
 import re
 from copy import deepcopy
 from collections.abc import Callable
+from functools import lru_cache
+from typing import Optional
 
 from pylatex.utils import NoEscape
 
@@ -12,10 +14,18 @@ import ttrpyg.dice_utils as du
 # parsing
 
 
-def parse_curlies(text: str) -> list[ty.Curly]:
+def parse_curlies(text: str, rng: Optional[du.RNG] = None) -> list[ty.Curly]:
+    return roll_curlies(compile_curlies(text), rng)
+
+
+@lru_cache(maxsize=4096)
+def compile_curlies(text: str) -> tuple[ty.Curly, ...]:
+    """The curlies in text without anything rolled: quantity and table_result are only set when they are fixed numbers.
+    The same text always compiles the same, so this is cached. Don't modify what it returns, roll_curlies makes copies.
+    """
     curlies = re.findall(r"{[^}]*}", text)
     dice_pattern = r"\d*?d\d+x?[+-]?\d*"
-    curlies_parsed = []
+    curlies_compiled = []
     if curlies:
         for match in curlies:
             # Check for entity...
@@ -27,7 +37,6 @@ def parse_curlies(text: str) -> list[ty.Curly]:
             # Check for quantity dice (leading dice)...
             if q := re.search(rf"(?<={{){dice_pattern}", match):
                 quantity_dice = q.group()
-                quantity = du.die_parser_roller(quantity_dice)
             # Check for number
             else:
                 if entity == "":
@@ -39,14 +48,14 @@ def parse_curlies(text: str) -> list[ty.Curly]:
                     quantity_dice = ""
             if entity and (t := re.search(rf"({dice_pattern})(?=}})", match)):
                 table_dice = t.group()
-                table_result = du.die_parser_roller(table_dice)
+                table_result = None
             elif entity and (t := re.search(r"(\d+)(?=})", match)):
                 table_dice = ""
                 table_result = int(t.group())
             else:
                 table_dice = ""
                 table_result = None
-            curlies_parsed.append(
+            curlies_compiled.append(
                 ty.Curly(
                     {
                         "match": match,
@@ -58,6 +67,21 @@ def parse_curlies(text: str) -> list[ty.Curly]:
                     }
                 )
             )
+    return tuple(curlies_compiled)
+
+
+def roll_curlies(
+    curlies_compiled: tuple[ty.Curly, ...], rng: Optional[du.RNG] = None
+) -> list[ty.Curly]:
+    """Rolls the dice in compiled curlies, in the order parse_curlies always has (each curly's quantity, then its table)."""
+    curlies_parsed = []
+    for curly in curlies_compiled:
+        curly = ty.Curly({**curly})
+        if curly["quantity_dice"]:
+            curly["quantity"] = du.die_parser_roller(curly["quantity_dice"], rng)
+        if curly["table_dice"]:
+            curly["table_result"] = du.die_parser_roller(curly["table_dice"], rng)
+        curlies_parsed.append(curly)
     return curlies_parsed
 
 